@@ -7,10 +7,18 @@ __author__ = "Marcel"
 __version__ = "2024.1"
 __license__ = "MIT"
 
+import os
 import argparse
 from telegram import Bot
+from telegram.utils.request import Request
 from logzero import logger, loglevel
+from moviebob import cache
+from moviebob import client
+from moviebob import daemon
+from moviebob import dispatch
 from moviebob import helper
+from moviebob import metrics
+from moviebob import pipeline
 from moviebob import poller
 from moviebob import telegram
 
@@ -23,26 +31,178 @@ def main(args):
 
     # Print arguments
     logger.debug(f"Arguments: %s" % args)
-    # Starting Bot
-    bot = Bot(args.telegram_bot_token)
     # Setup DB
-    db = helper.DB(args.database)
+    db = helper.DB(
+        args.database,
+        journal_mode=args.sqlite_journal_mode,
+        synchronous=args.sqlite_synchronous,
+        cache_size=args.sqlite_cache_size,
+        mmap_size=args.sqlite_mmap_size,
+        temp_store=args.sqlite_temp_store,
+        busy_timeout=args.sqlite_busy_timeout,
+    )
+    if args.rebuild_stats:
+        db.rebuild_stats()
+        db.close()
+        exit(0)
+
+    # Starting Bot
+    bot = Bot(
+        args.telegram_bot_token,
+        base_url=args.telegram_api_url,
+        # One connection per dispatcher worker
+        request=Request(con_pool_size=args.telegram_workers),
+    )
+    # Setup TMDB response cache next to the database unless disabled
+    response_cache = None
+    if args.tmdb_cache_size > 0:
+        cache_path = args.tmdb_cache or (
+            os.path.splitext(args.database)[0] + "_cache.db"
+        )
+        response_cache = cache.ResponseCache(
+            cache_path, max_size=args.tmdb_cache_size * 1024 * 1024
+        )
 
     if args.letterboxd_user is None:
         logger.info("No Letterboxd users provided - nothing to fetch. Exiting ...")
         exit(1)
 
     user_list = poller.setup_users(args.letterboxd_user, db)
-    poller.fetch_movies(user_list, db)
-    poller.fetch_movie_tmdb_ids(db)
-    poller.update_letterboxd_avg(db)
-    poller.fetch_movie_tmdb_details(db, args.tmdb_api_token)
-    telegram.send_movie_updates(db, bot, args.telegram_chat_id, user_list)
-    telegram.fetch_monthly_update(db, bot, args.telegram_chat_id)
-    telegram.fetch_yearly_update(db, bot, args.telegram_chat_id)
+    dispatcher = dispatch.Dispatcher(
+        bot, global_rate=args.telegram_rate, workers=args.telegram_workers
+    )
+    poller.validate_tmdb_api_key(args.tmdb_api_token, response_cache)
+    stream = pipeline.Pipeline(
+        db,
+        user_list,
+        dispatcher,
+        args.telegram_chat_id,
+        args.tmdb_api_token,
+        feed_workers=args.feed_workers,
+        host_limit=args.feed_host_limit,
+        tmdb_workers=args.tmdb_workers,
+        tmdb_rate=args.tmdb_rate,
+        response_cache=response_cache,
+        digest_threshold=args.digest_threshold,
+    )
+    stream.start()
+    stream.ingest_pending()
+    if args.daemon:
+        run_daemon(args, db, stream, dispatcher, response_cache)
+        stream.stop(finish_maintenance=False)
+    else:
+        run_once(args, db, stream, dispatcher, response_cache)
+    metrics.export(args.metrics_json, args.metrics_prom)
+    db.close()
+    if response_cache is not None:
+        response_cache.close()
+    client.close()
 
 
-if __name__ == "__main__":
+def run_once(args, db, stream, dispatcher, response_cache):
+    """
+    Processes every feed once and waits for all work to finish
+    :return:
+    """
+    with metrics.stage("run"):
+        stream.ingest_feeds()
+        stream.maintain(
+            "tmdb",
+            lambda pause: retry_tmdb(args, db, response_cache, stream.limiter, pause),
+        )
+        stream.maintain(
+            "letterboxd_avg",
+            lambda pause: poller.update_letterboxd_avg(
+                db, pause=pause, budget=args.avg_refresh_budget
+            ),
+        )
+        stream.join()
+        telegram.fetch_monthly_update(db, args.telegram_chat_id)
+        telegram.fetch_yearly_update(db, args.telegram_chat_id)
+        telegram.drain_outbox(db, dispatcher)
+        stream.stop()
+
+
+def retry_tmdb(args, db, response_cache, limiter, pause):
+    """
+    Retries tmdb ids and details that could not be fetched before. TMDB
+    requests share the pipeline's limiter, so both together stay within
+    `--tmdb-rate`.
+    :return:
+    """
+    poller.fetch_movie_tmdb_ids(db, pause=pause)
+    poller.fetch_movie_tmdb_details(
+        db,
+        args.tmdb_api_token,
+        workers=args.tmdb_workers,
+        response_cache=response_cache,
+        validate=False,
+        limiter=limiter,
+        pause=pause,
+    )
+
+
+def run_daemon(args, db, stream, dispatcher, response_cache):
+    """
+    Keeps the process, database and http sessions alive and runs every
+    stage on its own schedule. New movies flow through the pipeline, long
+    running maintenance is left to its low priority thread.
+    :return:
+    """
+    scheduler = daemon.Daemon()
+
+    def feeds():
+        stream.ingest_feeds()
+
+    def tmdb():
+        stream.maintain(
+            "tmdb",
+            lambda pause: retry_tmdb(args, db, response_cache, stream.limiter, pause),
+        )
+
+    def notify():
+        # Movies a failing stage left pending go through the pipeline again,
+        # only while it is idle so nothing in flight gets queued twice
+        if not stream.busy():
+            stream.ingest_pending()
+        # A drain of the pipeline sends everything due, waiting for it would
+        # only hold up the other stages
+        telegram.drain_outbox(db, dispatcher, blocking=False)
+
+    def recaps():
+        telegram.fetch_monthly_update(db, args.telegram_chat_id)
+        telegram.fetch_yearly_update(db, args.telegram_chat_id)
+        scheduler.trigger("notify")
+
+    def letterboxd_avg():
+        stream.maintain(
+            "letterboxd_avg",
+            lambda pause: poller.update_letterboxd_avg(
+                db, pause=pause, budget=args.avg_refresh_budget
+            ),
+        )
+
+    scheduler.add("feeds", feeds, args.feed_interval)
+    scheduler.add("tmdb", tmdb, args.tmdb_interval, run_at_start=False)
+    scheduler.add("notify", notify, args.notify_interval)
+    scheduler.add("recaps", recaps, daemon.seconds_until_next_month)
+    scheduler.add(
+        "letterboxd_avg",
+        letterboxd_avg,
+        lambda: daemon.seconds_until_hour(args.avg_refresh_hour),
+        run_at_start=False,
+    )
+    if args.metrics_json or args.metrics_prom:
+        scheduler.add(
+            "metrics",
+            lambda: metrics.export(args.metrics_json, args.metrics_prom),
+            args.metrics_interval,
+            run_at_start=False,
+        )
+    scheduler.run()
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     # Telegram Chat ID
@@ -50,7 +210,6 @@ if __name__ == "__main__":
         "-i",
         "--telegram_chat_id",
         action="store",
-        required=True,
         help="Telegram chat ID to report to",
     )
 
@@ -59,10 +218,18 @@ if __name__ == "__main__":
         "-t",
         "--telegram_bot_token",
         action="store",
-        required=True,
         help="Telegram Bot token to send messages",
     )
 
+    # Telegram Bot API server
+    parser.add_argument(
+        "--telegram-api-url",
+        action="store",
+        default="https://api.telegram.org/bot",
+        help="Base url of the Telegram Bot API, e.g. of a self-hosted Bot API "
+        "server. Defaults to `https://api.telegram.org/bot`",
+    )
+
     # Letterboxd User List
     parser.add_argument(
         "-l",
@@ -81,15 +248,237 @@ if __name__ == "__main__":
         help="Location of SQLite Database file. Defaults to `./moviebob.db`",
     )
 
+    # SQLite storage profile
+    parser.add_argument(
+        "--sqlite-journal-mode",
+        action="store",
+        type=str.upper,
+        choices=helper.JOURNAL_MODES,
+        default="WAL",
+        help="SQLite journal mode. Use `DELETE` on file systems without shared "
+        "memory support (e.g. NFS). Defaults to `WAL`",
+    )
+    parser.add_argument(
+        "--sqlite-synchronous",
+        action="store",
+        type=str.upper,
+        choices=helper.SYNCHRONOUS_MODES,
+        default="NORMAL",
+        help="SQLite synchronous mode. Defaults to `NORMAL`",
+    )
+    parser.add_argument(
+        "--sqlite-cache-size",
+        action="store",
+        type=int,
+        default=16,
+        help="SQLite page cache in MB. Defaults to `16`",
+    )
+    parser.add_argument(
+        "--sqlite-mmap-size",
+        action="store",
+        type=int,
+        default=128,
+        help="SQLite memory mapped I/O in MB, `0` disables it. Defaults to `128`",
+    )
+    parser.add_argument(
+        "--sqlite-temp-store",
+        action="store",
+        type=str.upper,
+        choices=helper.TEMP_STORES,
+        default="MEMORY",
+        help="Where SQLite keeps temporary tables and indices. Defaults to `MEMORY`",
+    )
+    parser.add_argument(
+        "--sqlite-busy-timeout",
+        action="store",
+        type=int,
+        default=5000,
+        help="Milliseconds to wait for a database lock held by another "
+        "process. Defaults to `5000`",
+    )
+
     # TMDB API Key
     parser.add_argument(
         "-T",
         "--tmdb_api_token",
         action="store",
-        required=True,
         help="TMDB Api Key to retrieve more informations about movies",
     )
 
+    # Parallel feed downloads
+    parser.add_argument(
+        "--feed-workers",
+        action="store",
+        type=int,
+        default=8,
+        help="Number of rss feeds downloaded in parallel. Defaults to `8`",
+    )
+
+    # Parallel requests per host
+    parser.add_argument(
+        "--feed-host-limit",
+        action="store",
+        type=int,
+        default=4,
+        help="Maximum parallel feed requests to the same host. Defaults to `4`",
+    )
+
+    # Parallel TMDB requests
+    parser.add_argument(
+        "--tmdb-workers",
+        action="store",
+        type=int,
+        default=8,
+        help="Number of TMDB requests in flight. Defaults to `8`",
+    )
+
+    # TMDB request rate
+    parser.add_argument(
+        "--tmdb-rate",
+        action="store",
+        type=float,
+        default=40,
+        help="Maximum TMDB requests per second. Defaults to `40`",
+    )
+
+    # TMDB response cache
+    parser.add_argument(
+        "--tmdb-cache",
+        action="store",
+        help="Location of the TMDB response cache file. Defaults to "
+        "`<database>_cache.db` next to the database",
+    )
+
+    # TMDB response cache size
+    parser.add_argument(
+        "--tmdb-cache-size",
+        action="store",
+        type=int,
+        default=64,
+        help="Maximum size of the TMDB response cache in MB, `0` disables "
+        "the cache. Defaults to `64`",
+    )
+
+    # Digest notifications
+    parser.add_argument(
+        "--digest-threshold",
+        action="store",
+        type=int,
+        default=0,
+        help="Pack pending movie notifications into digest messages when more "
+        "than this many are pending. Defaults to `0` (never)",
+    )
+
+    # Telegram message rate
+    parser.add_argument(
+        "--telegram-rate",
+        action="store",
+        type=float,
+        default=30,
+        help="Maximum telegram messages per second across all chats. "
+        "Defaults to `30`",
+    )
+
+    # Parallel telegram requests
+    parser.add_argument(
+        "--telegram-workers",
+        action="store",
+        type=int,
+        default=4,
+        help="Number of telegram requests in flight. Defaults to `4`",
+    )
+
+    # Rebuild statistics rollup
+    parser.add_argument(
+        "--rebuild-stats",
+        action="store_true",
+        help="Recompute the monthly user statistics from the full movie "
+        "history and exit",
+    )
+
+    # Daemon mode
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and poll every stage on its own schedule instead "
+        "of exiting after one run",
+    )
+
+    # Daemon feed interval
+    parser.add_argument(
+        "--feed-interval",
+        action="store",
+        type=int,
+        default=300,
+        help="Seconds between rss feed polls in daemon mode. Defaults to `300`",
+    )
+
+    # Daemon TMDB interval
+    parser.add_argument(
+        "--tmdb-interval",
+        action="store",
+        type=int,
+        default=3600,
+        help="Seconds between retries of missing TMDB ids and details in "
+        "daemon mode, new movies are enriched right away. Defaults to `3600`",
+    )
+
+    # Daemon notify interval
+    parser.add_argument(
+        "--notify-interval",
+        action="store",
+        type=int,
+        default=60,
+        help="Seconds between outbox drains in daemon mode. Defaults to `60`",
+    )
+
+    # Daemon Letterboxd average refresh
+    parser.add_argument(
+        "--avg-refresh-hour",
+        action="store",
+        type=int,
+        choices=range(24),
+        metavar="HOUR",
+        default=4,
+        help="Local hour of the nightly Letterboxd average refresh in daemon "
+        "mode. Defaults to `4`",
+    )
+
+    # Letterboxd average refresh budget
+    parser.add_argument(
+        "--avg-refresh-budget",
+        action="store",
+        type=int,
+        default=500,
+        help="Maximum number of film pages requested per Letterboxd average "
+        "refresh, the most overdue films go first. Defaults to `500`",
+    )
+
+    # Metrics as JSON
+    parser.add_argument(
+        "--metrics-json",
+        action="store",
+        help="Write stage durations, http, database and telegram metrics to "
+        "this JSON file after every run",
+    )
+
+    # Metrics for Prometheus
+    parser.add_argument(
+        "--metrics-prom",
+        action="store",
+        help="Write the metrics in Prometheus text format to this file, e.g. "
+        "into the textfile collector directory of node_exporter",
+    )
+
+    # Daemon metrics interval
+    parser.add_argument(
+        "--metrics-interval",
+        action="store",
+        type=int,
+        default=60,
+        help="Seconds between metric exports in daemon mode. Defaults to `60`",
+    )
+
     # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
     parser.add_argument(
         "-v", "--verbose", action="count", default=0, help="Verbosity (-v, -vv, etc)"
@@ -102,5 +491,24 @@ if __name__ == "__main__":
         version="%(prog)s (version {version})".format(version=__version__),
     )
 
-    args = parser.parse_args()
-    main(args)
+    args = parser.parse_args(argv)
+    # Rebuilding the statistics only touches the database
+    if not args.rebuild_stats:
+        missing = [
+            flag
+            for flag, value in (
+                ("-i/--telegram_chat_id", args.telegram_chat_id),
+                ("-t/--telegram_bot_token", args.telegram_bot_token),
+                ("-T/--tmdb_api_token", args.tmdb_api_token),
+            )
+            if value is None
+        ]
+        if missing:
+            parser.error(
+                "the following arguments are required: %s" % ", ".join(missing)
+            )
+    return args
+
+
+if __name__ == "__main__":
+    main(parse_args())
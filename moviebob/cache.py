@@ -0,0 +1,126 @@
+import sqlite3
+import threading
+from time import time
+from logzero import logger
+from moviebob import metrics
+
+# Time to live per resource in seconds
+TTL_DAY = 24 * 60 * 60
+TTL_AUTHENTICATION = TTL_DAY
+TTL_MOVIE = 180 * TTL_DAY
+TTL_MOVIE_INCOMPLETE = TTL_DAY
+
+
+class ResponseCache:
+    """
+    On-disk cache for api responses, stored in its own SQLite file. Entries
+    expire after a per-resource TTL and the least recently used ones are
+    evicted once the stored bodies exceed `max_size` bytes.
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        logger.debug("Setting up response cache at '%s' ..." % path)
+        self.con = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # Losing the newest cache entries on a crash is harmless
+            self.con.execute("PRAGMA journal_mode = WAL")
+            self.con.execute("PRAGMA synchronous = NORMAL")
+            self.con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses(
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """
+            )
+            self.con.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at)"
+            )
+            self.size = self.con.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+
+    def get(self, key):
+        """
+        Returns the cached body for `key` or None if missing or expired
+        :param key: endpoint and id, e.g. `tmdb:/3/movie/603`
+        :return:
+        """
+        now = time()
+        with self.lock:
+            row = self.con.execute(
+                "SELECT body, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                metrics.inc("moviebob_cache_requests_total", result="miss")
+                return None
+            if row[1] < now:
+                self._delete(key)
+                metrics.inc("moviebob_cache_requests_total", result="expired")
+                return None
+            metrics.inc("moviebob_cache_requests_total", result="hit")
+            self.con.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            return row[0]
+
+    def set(self, key, body, ttl):
+        """
+        Stores `body` for `ttl` seconds and evicts old entries if needed
+        :param key:
+        :param body: bytes
+        :param ttl:
+        :return:
+        """
+        now = time()
+        with self.lock:
+            self._delete(key)
+            self.con.execute(
+                """
+                INSERT INTO responses(key, body, size, expires_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?)
+            """,
+                (key, body, len(body), now + ttl, now),
+            )
+            self.size += len(body)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _delete(self, key):
+        row = self.con.execute(
+            "SELECT size FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            self.con.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.size -= row[0]
+
+    def _evict(self):
+        # Drop expired entries first, then least recently used down to 90%
+        self.con.execute("BEGIN")
+        self.con.execute("DELETE FROM responses WHERE expires_at < ?", (time(),))
+        size = self.con.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        target = self.max_size * 0.9
+        for key, entry_size in self.con.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if size <= target:
+                break
+            self.con.execute("DELETE FROM responses WHERE key = ?", (key,))
+            size -= entry_size
+        self.con.execute("COMMIT")
+        logger.debug(
+            "Evicted response cache from %s down to %s bytes." % (self.size, size)
+        )
+        self.size = size
+
+    def close(self):
+        with self.lock:
+            self.con.close()
@@ -0,0 +1,117 @@
+import threading
+import requests
+from time import monotonic
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from moviebob import metrics
+
+LETTERBOXD_URL = "https://letterboxd.com"
+TMDB_URL = "https://api.themoviedb.org"
+
+letterboxd_headers = {
+    "referer": "https://letterboxd.com",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class Session(requests.Session):
+    """
+    requests.Session with pooled keep-alive connections, a retry policy for
+    transient errors and a default timeout for every request
+    """
+
+    def __init__(
+        self,
+        timeout=(5, 30),
+        retries=3,
+        retry_statuses=(429, 500, 502, 503, 504),
+        respect_retry_after=True,
+        pool_size=16,
+    ):
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=retry_statuses,
+            allowed_methods=("GET", "HEAD"),
+            respect_retry_after_header=respect_retry_after,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlparse(url).netloc
+        started = monotonic()
+        try:
+            resp = super().request(method, url, **kwargs)
+        except requests.RequestException as err:
+            metrics.inc(
+                "moviebob_http_errors_total", host=host, error=type(err).__name__
+            )
+            raise
+        # Includes the time spent on retries inside the adapter
+        metrics.observe(
+            "moviebob_http_request_duration_seconds", monotonic() - started, host=host
+        )
+        metrics.inc(
+            "moviebob_http_requests_total",
+            host=host,
+            status=resp.status_code,
+            stage=metrics.current_stage(),
+        )
+        retries = getattr(resp.raw, "retries", None)
+        if retries is not None and retries.history:
+            metrics.inc(
+                "moviebob_http_retries_total", len(retries.history), host=host
+            )
+        return resp
+
+
+def _get_session(name, headers, **kwargs):
+    with _sessions_lock:
+        if name not in _sessions:
+            session = Session(**kwargs)
+            session.headers.update(headers)
+            _sessions[name] = session
+        return _sessions[name]
+
+
+def letterboxd():
+    """
+    Shared session for rss feeds and film pages on letterboxd.com
+    :return:
+    """
+    return _get_session("letterboxd", letterboxd_headers)
+
+
+def tmdb(api_key):
+    """
+    Shared session for the TMDB api, authenticated with the given key.
+    Rate limit responses (429) are not retried here, callers back off with
+    their own limiter instead.
+    :param api_key:
+    :return:
+    """
+    return _get_session(
+        "tmdb",
+        {"accept": "application/json", "Authorization": "Bearer %s" % api_key},
+        retry_statuses=(500, 502, 503, 504),
+        respect_retry_after=False,
+    )
+
+
+def close():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,110 @@
+import signal
+import threading
+from logzero import logger
+from time import monotonic
+from datetime import datetime, timedelta
+from dateutil import relativedelta
+from moviebob import metrics
+
+
+def seconds_until_hour(hour):
+    """
+    Interval that runs a stage every night at the given local hour
+    :param hour:
+    :return:
+    """
+    now = datetime.now()
+    target = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if target <= now:
+        target = target + timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+def seconds_until_next_month():
+    """
+    Interval that runs a stage right after every month boundary
+    :return:
+    """
+    now = datetime.now()
+    target = datetime(now.year, now.month, 1) + relativedelta.relativedelta(
+        months=1, minutes=1
+    )
+    return (target - now).total_seconds()
+
+
+class Stage:
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = monotonic()
+
+    def delay(self):
+        if callable(self.interval):
+            return self.interval()
+        return self.interval
+
+
+class Daemon:
+    """
+    Runs every stage on its own schedule in the calling thread until SIGTERM
+    or SIGINT. Stages run one after another, a stage can `trigger` another
+    one to run next instead of waiting for its interval.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+
+    def add(self, name, func, interval, run_at_start=True):
+        """
+        Registers a stage
+        :param name:
+        :param func: called without arguments
+        :param interval: seconds between runs or a callable returning them
+        :param run_at_start: otherwise the first run waits one interval
+        :return:
+        """
+        stage = Stage(name, func, interval)
+        if not run_at_start:
+            stage.next_run = monotonic() + stage.delay()
+        self.stages[name] = stage
+
+    def trigger(self, name):
+        self.stages[name].next_run = monotonic()
+        self.wakeup.set()
+
+    def stop(self, signum=None, frame=None):
+        logger.info("Stopping daemon after the current stage ...")
+        self.stop_event.set()
+        self.wakeup.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(
+            "Daemon started with stages: %s" % ", ".join(self.stages.keys())
+        )
+        while not self.stop_event.is_set():
+            stage = min(self.stages.values(), key=lambda stage: stage.next_run)
+            wait = stage.next_run - monotonic()
+            if wait > 0:
+                self.wakeup.wait(wait)
+                self.wakeup.clear()
+                continue
+            logger.debug("Running stage '%s' ..." % stage.name)
+            started = monotonic()
+            try:
+                with metrics.stage("daemon_%s" % stage.name):
+                    stage.func()
+            except Exception as err:
+                logger.exception("Stage '%s' failed: %s" % (stage.name, err))
+            # A trigger during the run keeps the stage due
+            if stage.next_run <= started:
+                stage.next_run = monotonic() + stage.delay()
+            logger.debug(
+                "Stage '%s' took %.2f seconds, next run in %.0f seconds."
+                % (stage.name, monotonic() - started, stage.next_run - monotonic())
+            )
+        logger.info("Daemon stopped.")
@@ -0,0 +1,227 @@
+import heapq
+import itertools
+import threading
+import telegram
+from collections import deque
+from logzero import logger
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from moviebob import metrics
+from moviebob import ratelimit
+
+# Telegram's documented limits for bots
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+GROUP_RATE = 20 / 60
+GROUP_BURST = 20
+
+
+class Message:
+    def __init__(
+        self,
+        chat_id,
+        text,
+        on_success=None,
+        on_failure=None,
+        on_send=None,
+        on_retry=None,
+    ):
+        self.chat_id = chat_id
+        self.text = text
+        self.on_send = on_send
+        self.on_retry = on_retry
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.attempts = 0
+        self.throttles = 0
+
+
+class Dispatcher:
+    """
+    Single outbound queue for telegram messages. Messages are sent in order
+    per chat, as fast as the global and per-chat token buckets allow. Rate
+    limited or failed messages are rescheduled instead of blocking the
+    caller, the outcome of every message is reported through its
+    `on_success` / `on_failure` callback. Long or repeated rate limits are
+    reported as failures, so `run` always returns.
+    """
+
+    def __init__(
+        self,
+        bot,
+        global_rate=GLOBAL_RATE,
+        max_attempts=3,
+        retry_delay=3,
+        workers=4,
+        max_throttles=5,
+        max_throttle_delay=60,
+    ):
+        self.bot = bot
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_throttles = max_throttles
+        self.max_throttle_delay = max_throttle_delay
+        self.workers = workers
+        self.global_bucket = ratelimit.TokenBucket(global_rate)
+        self.chat_buckets = {}
+        # Pending messages per chat, only the head of each queue is scheduled
+        self.queues = {}
+        self.heap = []
+        self.in_flight = set()
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def _buckets(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            buckets = [ratelimit.TokenBucket(CHAT_RATE)]
+            if str(chat_id).startswith("-"):
+                # Negative ids are groups and channels
+                buckets.append(ratelimit.TokenBucket(GROUP_RATE, GROUP_BURST))
+            self.chat_buckets[chat_id] = buckets
+        return [self.global_bucket] + self.chat_buckets[chat_id]
+
+    def _schedule(self, chat_id, delay=0):
+        heapq.heappush(self.heap, (monotonic() + delay, next(self.counter), chat_id))
+        self.cond.notify()
+
+    def submit(
+        self,
+        chat_id,
+        text,
+        on_success=None,
+        on_failure=None,
+        on_send=None,
+        on_retry=None,
+    ):
+        """
+        Queues a message without sending it
+        :param chat_id:
+        :param text:
+        :param on_success: called without arguments once delivered
+        :param on_failure: called with the last error after `max_attempts`,
+                           or once rate limits exceed `max_throttles` or
+                           `max_throttle_delay`
+        :param on_send: called without arguments right before every attempt
+        :param on_retry: called without arguments when an attempt did not
+                         deliver the message and another one is scheduled
+        :return:
+        """
+        with self.cond:
+            queue = self.queues.setdefault(chat_id, deque())
+            queue.append(
+                Message(chat_id, text, on_success, on_failure, on_send, on_retry)
+            )
+            if len(queue) == 1 and chat_id not in self.in_flight:
+                self._schedule(chat_id)
+
+    def run(self):
+        """
+        Sends queued messages until every queue is drained
+        :return:
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            with self.cond:
+                while self.heap or self.in_flight:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    ready_at, _, chat_id = self.heap[0]
+                    now = monotonic()
+                    if ready_at > now:
+                        self.cond.wait(ready_at - now)
+                        continue
+                    heapq.heappop(self.heap)
+                    buckets = self._buckets(chat_id)
+                    delay = max(bucket.delay() for bucket in buckets)
+                    if delay:
+                        self._schedule(chat_id, delay)
+                        continue
+                    for bucket in buckets:
+                        bucket.try_acquire()
+                    self.in_flight.add(chat_id)
+                    pool.submit(self._send, self.queues[chat_id][0])
+
+    def _send(self, msg):
+        with metrics.stage("dispatch_send"):
+            self._attempt(msg)
+
+    def _attempt(self, msg):
+        msg.attempts = msg.attempts + 1
+        error = None
+        try:
+            if msg.on_send is not None:
+                msg.on_send()
+            logger.info(
+                f"Attempt %s: Sending Notification: %s" % (msg.attempts, msg.text)
+            )
+            started = monotonic()
+            self.bot.sendMessage(chat_id=msg.chat_id, text=msg.text)
+            metrics.observe(
+                "moviebob_telegram_request_duration_seconds", monotonic() - started
+            )
+            metrics.inc("moviebob_telegram_requests_total", result="sent")
+        except telegram.error.RetryAfter as err:
+            metrics.inc("moviebob_telegram_requests_total", result="retry_after")
+            logger.info(
+                f"Sending '%s' was blocked. Retrying in %s seconds ..."
+                % (msg.text, err.retry_after)
+            )
+            # Being throttled is not the message's fault
+            msg.attempts = msg.attempts - 1
+            msg.throttles = msg.throttles + 1
+            for bucket in self.chat_buckets[msg.chat_id]:
+                bucket.pause(err.retry_after)
+            if (
+                msg.throttles > self.max_throttles
+                or err.retry_after > self.max_throttle_delay
+            ):
+                logger.info(
+                    f"Sending '%s' stays blocked. Handing it back ..." % msg.text
+                )
+                self._callback(msg, msg.on_failure, err)
+                self._done(msg)
+                return
+            self._callback(msg, msg.on_retry)
+            self._done(msg, retry_delay=err.retry_after)
+            return
+        except telegram.error.TimedOut as err:
+            metrics.inc("moviebob_telegram_requests_total", result="timed_out")
+            logger.debug(f"Sending '%s' timed out!" % msg.text)
+            error = err
+        except Exception as err:
+            metrics.inc("moviebob_telegram_requests_total", result="error")
+            logger.debug(f"Unknown error while sending telegram message: %s" % err)
+            error = err
+
+        if error is None:
+            self._callback(msg, msg.on_success)
+        elif msg.attempts < self.max_attempts:
+            self._callback(msg, msg.on_retry)
+            self._done(msg, retry_delay=self.retry_delay)
+            return
+        else:
+            logger.info(f"Maximum attempts reached. Skipping '%s' ..." % msg.text)
+            self._callback(msg, msg.on_failure, error)
+        self._done(msg)
+
+    def _callback(self, msg, callback, *args):
+        # Runs before the message leaves its queue, so `run` can not return
+        # while bookkeeping is still pending
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception as err:
+            logger.exception(f"Callback for message '%s' failed: %s" % (msg.text, err))
+
+    def _done(self, msg, retry_delay=None):
+        with self.cond:
+            self.in_flight.discard(msg.chat_id)
+            queue = self.queues[msg.chat_id]
+            if retry_delay is not None:
+                self._schedule(msg.chat_id, retry_delay)
+                return
+            queue.popleft()
+            if queue:
+                self._schedule(msg.chat_id)
+            self.cond.notify()
@@ -1,98 +1,543 @@
+import os
+import json
+import uuid
 import sqlite3
+import threading
 from logzero import logger
 from contextlib import contextmanager
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+from moviebob import client
+from moviebob import metrics
+
+
+def add_column(cur, table, column, definition):
+    """
+    Adds a column unless an older tool version already created it
+    :param cur:
+    :param table:
+    :param column:
+    :param definition: column type and constraints
+    :return:
+    """
+    cur.execute("PRAGMA table_info(%s)" % table)
+    if column not in [row[1] for row in cur.fetchall()]:
+        logger.info("Column '%s' not found in table '%s'. Adding column ..." % (column, table))
+        cur.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition))
+
+
+def film_slug(url):
+    """
+    Returns the canonical film slug of a letterboxd review url, e.g.
+    `https://letterboxd.com/<user>/film/<slug>/` or, for some rewatches,
+    `https://letterboxd.com/<user>/film/<slug>/<n>/`
+    :param url:
+    :return: slug
+    """
+    urlList = list(filter(None, urlparse(url).path.split("/")))
+    if "film" in urlList[:-1]:
+        return urlList[urlList.index("film") + 1]
+    # Fallback for unexpected urls: a trailing number marks a rewatch
+    if urlList[-1].isdigit():
+        return urlList[-2]
+    return urlList[-1]
+
+
+def migrate_v1_base_schema(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users(
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            nickname TEXT NOT NULL,
+            feed_url TEXT NOT NULL
+        )
+    """
+    )
+    # ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS movies(
+            movie_id INTEGER PRIMARY KEY,
+            letterboxd_id TEXT NOT NULL UNIQUE,
+            tmdb_id INTEGER,
+            url TEXT NOT NULL,
+            title TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            rating TEXT NOT NULL,
+            rewatch INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            user INTEGER NOT NULL,
+            notified INTEGER NOT NULL
+        )
+    """
+    )
+    # Migration v2024.1
+    add_column(cur, "movies", "tmdb_id", "INTEGER")
+    # ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS monthly(
+            monthly_id INTEGER PRIMARY KEY,
+            month INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            notified INTEGER NOT NULL
+        )
+    """
+    )
+    # ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tmdb(
+            tmdb_id INTEGER PRIMARY KEY,
+            imdb_id INTEGER,
+            release_date TEXT,
+            runtime INTEGER,
+            letterboxd_avg REAL,
+            letterboxd_avg_date TEXT,
+            shortfilm INTEGER GENERATED ALWAYS AS (CASE WHEN runtime < 40 THEN 1 ELSE 0 END),
+            title TEXT NOT NULL
+        )"""
+    )
+    # ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS yearly(
+            yearly_id INTEGER PRIMARY KEY,
+            year INTEGER NOT NULL,
+            notified INTEGER NOT NULL
+        )
+        """
+    )
+
+
+def migrate_v2_feed_state(cur):
+    # Conditional feed requests
+    add_column(cur, "users", "feed_etag", "TEXT")
+    add_column(cur, "users", "feed_modified", "TEXT")
+    # Incremental feed processing
+    add_column(cur, "users", "last_letterboxd_id", "TEXT")
+    add_column(cur, "users", "last_published", "TEXT")
+
+
+def migrate_v3_indexes(cur):
+    # Pending movies are read oldest first
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS movies_pending ON movies(date, movie_id) WHERE notified = 0"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS movies_tmdb_id ON movies(tmdb_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS movies_url ON movies(url)")
+    cur.execute("CREATE INDEX IF NOT EXISTS movies_date ON movies(date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS movies_user_date ON movies(user, date)")
+
+
+# Contribution of one watch to its user_month_stats row, `{m}` is the movie
+# row (NEW/OLD) and `{sign}` 1 to add or -1 to remove it
+USER_MONTH_STATS_MOVIE_UPSERT = """
+    INSERT INTO user_month_stats(user, month, watches, rewatches, shortfilms, tmdb_count, runtime_sum, rating_sum, rating_count)
+    SELECT
+        {m}.user,
+        substr({m}.date, 1, 7),
+        {sign},
+        {sign} * ({m}.rewatch = 1),
+        {sign} * COALESCE(SUM(shortfilm = 1), 0),
+        {sign} * COUNT(tmdb_id),
+        {sign} * COALESCE(SUM(runtime), 0),
+        {sign} * COALESCE(SUM(letterboxd_avg), 0),
+        {sign} * COUNT(letterboxd_avg)
+    FROM tmdb
+    WHERE tmdb_id = {m}.tmdb_id
+    ON CONFLICT(user, month) DO UPDATE SET
+        watches = watches + excluded.watches,
+        rewatches = rewatches + excluded.rewatches,
+        shortfilms = shortfilms + excluded.shortfilms,
+        tmdb_count = tmdb_count + excluded.tmdb_count,
+        runtime_sum = runtime_sum + excluded.runtime_sum,
+        rating_sum = rating_sum + excluded.rating_sum,
+        rating_count = rating_count + excluded.rating_count;
+"""
+
+# Contribution of TMDB details to every watch of the film, `{t}` is the
+# tmdb row (NEW/OLD) and `{sign}` 1 to add or -1 to remove it
+USER_MONTH_STATS_TMDB_UPSERT = """
+    INSERT INTO user_month_stats(user, month, watches, rewatches, shortfilms, tmdb_count, runtime_sum, rating_sum, rating_count)
+    SELECT
+        user,
+        substr(date, 1, 7),
+        0,
+        0,
+        {sign} * COUNT(*) * ({t}.shortfilm = 1),
+        {sign} * COUNT(*),
+        {sign} * COUNT(*) * COALESCE({t}.runtime, 0),
+        {sign} * COUNT(*) * COALESCE({t}.letterboxd_avg, 0),
+        {sign} * COUNT(*) * ({t}.letterboxd_avg IS NOT NULL)
+    FROM movies
+    WHERE tmdb_id = {t}.tmdb_id
+    GROUP BY user, substr(date, 1, 7)
+    ON CONFLICT(user, month) DO UPDATE SET
+        shortfilms = shortfilms + excluded.shortfilms,
+        tmdb_count = tmdb_count + excluded.tmdb_count,
+        runtime_sum = runtime_sum + excluded.runtime_sum,
+        rating_sum = rating_sum + excluded.rating_sum,
+        rating_count = rating_count + excluded.rating_count;
+"""
+
+
+def migrate_v4_user_month_stats(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_month_stats(
+            user INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            watches INTEGER NOT NULL,
+            rewatches INTEGER NOT NULL,
+            shortfilms INTEGER NOT NULL,
+            tmdb_count INTEGER NOT NULL,
+            runtime_sum INTEGER NOT NULL,
+            rating_sum REAL NOT NULL,
+            rating_count INTEGER NOT NULL,
+            PRIMARY KEY (user, month)
+        )
+    """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS user_month_stats_month ON user_month_stats(month)")
+    # The triggers keep the rollup in the same transaction as the change
+    add_movie = USER_MONTH_STATS_MOVIE_UPSERT.format(m="NEW", sign=1)
+    remove_movie = USER_MONTH_STATS_MOVIE_UPSERT.format(m="OLD", sign=-1)
+    add_tmdb = USER_MONTH_STATS_TMDB_UPSERT.format(t="NEW", sign=1)
+    remove_tmdb = USER_MONTH_STATS_TMDB_UPSERT.format(t="OLD", sign=-1)
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS user_month_stats_movie_insert "
+        "AFTER INSERT ON movies BEGIN %s END" % add_movie
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS user_month_stats_movie_update "
+        "AFTER UPDATE OF tmdb_id, rewatch, date, user ON movies BEGIN %s %s END"
+        % (remove_movie, add_movie)
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS user_month_stats_movie_delete "
+        "AFTER DELETE ON movies BEGIN %s END" % remove_movie
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS user_month_stats_tmdb_insert "
+        "AFTER INSERT ON tmdb BEGIN %s END" % add_tmdb
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS user_month_stats_tmdb_update "
+        "AFTER UPDATE OF tmdb_id, runtime, letterboxd_avg ON tmdb "
+        "WHEN NEW.tmdb_id IS NOT OLD.tmdb_id OR NEW.runtime IS NOT OLD.runtime "
+        "OR NEW.letterboxd_avg IS NOT OLD.letterboxd_avg BEGIN %s %s END"
+        % (remove_tmdb, add_tmdb)
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS user_month_stats_tmdb_delete "
+        "AFTER DELETE ON tmdb BEGIN %s END" % remove_tmdb
+    )
+    rebuild_user_month_stats(cur)
+
+
+def rebuild_user_month_stats(cur):
+    """
+    Recomputes the whole user_month_stats rollup from the movie history
+    :param cur:
+    :return:
+    """
+    cur.execute("DELETE FROM user_month_stats")
+    cur.execute(
+        """
+        INSERT INTO user_month_stats(user, month, watches, rewatches, shortfilms, tmdb_count, runtime_sum, rating_sum, rating_count)
+        SELECT
+            user,
+            substr(date, 1, 7),
+            COUNT(movie_id),
+            SUM(rewatch = 1),
+            COALESCE(SUM(shortfilm = 1), 0),
+            COUNT(tmdb.tmdb_id),
+            COALESCE(SUM(runtime), 0),
+            COALESCE(SUM(letterboxd_avg), 0),
+            COUNT(letterboxd_avg)
+        FROM movies
+        LEFT JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
+        GROUP BY user, substr(date, 1, 7)
+    """
+    )
+
+
+def migrate_v5_outbox(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY,
+            dedupe_key TEXT NOT NULL UNIQUE,
+            chat_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            movie_ids TEXT NOT NULL DEFAULT '[]',
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL DEFAULT (datetime('now')),
+            last_error TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            sent_at TEXT,
+            claimed_by TEXT,
+            claimed_at TEXT
+        )
+    """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS outbox_due ON outbox(next_attempt_at) "
+        "WHERE status IN ('pending', 'sending')"
+    )
+
+
+def sql_local_time(modifier=None):
+    """
+    SQL expression of the local time in the format of
+    `datetime.isoformat(timespec="seconds")`, so timestamps written by SQL
+    and Python compare as strings
+    :param modifier: optional SQL expression of a date modifier, e.g. `'+1 day'`
+    :return:
+    """
+    arguments = ["'%Y-%m-%dT%H:%M:%S'", "'now'", "'localtime'"]
+    if modifier is not None:
+        arguments.append(modifier)
+    return "strftime(%s)" % ", ".join(arguments)
+
+
+# A new watch pulls the next refresh of the film's average forward to this
+LETTERBOXD_AVG_WATCHED = """
+    UPDATE tmdb
+    SET letterboxd_avg_due = MIN(letterboxd_avg_due, %s)
+    WHERE tmdb_id = NEW.tmdb_id;
+""" % sql_local_time(
+    "'+1 day'"
+)
+
+
+def migrate_v6_letterboxd_avg_schedule(cur):
+    # Due date and interval in days of the next letterboxd average refresh
+    add_column(cur, "tmdb", "letterboxd_avg_due", "TEXT NOT NULL DEFAULT '0'")
+    add_column(cur, "tmdb", "letterboxd_avg_interval", "REAL")
+    # Spread the films checked before over the next 30 days instead of
+    # letting them all expire on the same night
+    spread = sql_local_time("'+' || (abs(random()) % 2592000) || ' seconds'")
+    cur.execute(
+        "UPDATE tmdb SET letterboxd_avg_due = %s WHERE letterboxd_avg_date > '0'"
+        % spread
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS tmdb_letterboxd_avg_due ON tmdb(letterboxd_avg_due)"
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS letterboxd_avg_watched_insert "
+        "AFTER INSERT ON movies WHEN NEW.tmdb_id BEGIN %s END"
+        % LETTERBOXD_AVG_WATCHED
+    )
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS letterboxd_avg_watched_update "
+        "AFTER UPDATE OF tmdb_id ON movies "
+        "WHEN NEW.tmdb_id AND NEW.tmdb_id IS NOT OLD.tmdb_id BEGIN %s END"
+        % LETTERBOXD_AVG_WATCHED
+    )
+
+
+def migrate_v7_tmdb_slug(cur):
+    # Film slug resolved at ingest, the refresh needs no movie lookup
+    add_column(cur, "tmdb", "slug", "TEXT")
+    # Latest watch of a film straight from the index
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS movies_tmdb_id_date ON movies(tmdb_id, date)"
+    )
+    cur.execute("DROP INDEX IF EXISTS movies_tmdb_id")
+    cur.execute(
+        """
+        SELECT tmdb_id, MIN(url)
+        FROM movies
+        WHERE tmdb_id != 0
+        GROUP BY tmdb_id
+    """
+    )
+    slugs = []
+    for tmdb_id, url in cur.fetchall():
+        try:
+            slugs.append((film_slug(url), tmdb_id))
+        except Exception as e:
+            logger.warning("Could not parse film of url '%s': %s" % (url, e))
+    cur.executemany(
+        "UPDATE tmdb SET slug = ? WHERE tmdb_id = ? AND slug IS NULL", slugs
+    )
+    logger.info("Stored the film slug of %s tmdb entries." % len(slugs))
+
+
+# Ordered schema migrations, the position in the list is the schema version
+# stored in `PRAGMA user_version` after the migration got applied.
+MIGRATIONS = [
+    migrate_v1_base_schema,
+    migrate_v2_feed_state,
+    migrate_v3_indexes,
+    migrate_v4_user_month_stats,
+    migrate_v5_outbox,
+    migrate_v6_letterboxd_avg_schedule,
+    migrate_v7_tmdb_slug,
+]
+
+
+JOURNAL_MODES = ("WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY")
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+TEMP_STORES = ("DEFAULT", "FILE", "MEMORY")
 
 
 class DB:
-    def __init__(self, database_path):
+    def __init__(
+        self,
+        database_path,
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=16,
+        mmap_size=128,
+        temp_store="MEMORY",
+        busy_timeout=5000,
+    ):
+        """
+        Opens the database and applies the storage profile
+        :param database_path:
+        :param journal_mode: one of JOURNAL_MODES
+        :param synchronous: one of SYNCHRONOUS_MODES
+        :param cache_size: page cache in MB
+        :param mmap_size: memory mapped I/O in MB, 0 disables it
+        :param temp_store: one of TEMP_STORES
+        :param busy_timeout: milliseconds to wait for a lock held elsewhere
+        """
         self.path = database_path
         logger.debug("Setting up database...")
+        # One long-lived connection shared by every stage. Transactions are
+        # managed explicitly (see `transaction()`), so autocommit is enabled
+        # on the driver and the lock serializes access across threads.
+        self.con = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.RLock()
+        self._depth = 0
+        self.configure(
+            journal_mode, synchronous, cache_size, mmap_size, temp_store, busy_timeout
+        )
+        self.migrate()
 
-        with self.ops() as cur:
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users(
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT NOT NULL UNIQUE,
-                    nickname TEXT NOT NULL,
-                    feed_url TEXT NOT NULL
-                )
-            """
-            )
-            # ---
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS movies(
-                    movie_id INTEGER PRIMARY KEY,
-                    letterboxd_id TEXT NOT NULL UNIQUE,
-                    tmdb_id INTEGER,
-                    url TEXT NOT NULL,
-                    title TEXT NOT NULL,
-                    year INTEGER NOT NULL,
-                    rating TEXT NOT NULL,
-                    rewatch INTEGER NOT NULL,
-                    date TEXT NOT NULL,
-                    user INTEGER NOT NULL,
-                    notified INTEGER NOT NULL
+    def configure(
+        self, journal_mode, synchronous, cache_size, mmap_size, temp_store, busy_timeout
+    ):
+        if journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError("Unknown journal mode '%s'" % journal_mode)
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError("Unknown synchronous mode '%s'" % synchronous)
+        if temp_store.upper() not in TEMP_STORES:
+            raise ValueError("Unknown temp store '%s'" % temp_store)
+
+        with self._lock:
+            # Busy timeout first, switching the journal mode may need a lock
+            self.con.execute("PRAGMA busy_timeout = %d" % int(busy_timeout))
+            mode = self.con.execute(
+                "PRAGMA journal_mode = %s" % journal_mode.upper()
+            ).fetchone()[0]
+            if mode.upper() != journal_mode.upper():
+                logger.warning(
+                    "Could not switch journal mode to '%s', using '%s'."
+                    % (journal_mode, mode)
                 )
-            """
-            )
-            # Migration v2024.1
+            self.con.execute("PRAGMA synchronous = %s" % synchronous.upper())
+            # Negative values are KiB instead of pages
+            self.con.execute("PRAGMA cache_size = %d" % -(int(cache_size) * 1024))
+            self.con.execute("PRAGMA mmap_size = %d" % (int(mmap_size) * 1024 * 1024))
+            self.con.execute("PRAGMA temp_store = %s" % temp_store.upper())
+        logger.debug(
+            "Storage profile: journal_mode=%s, synchronous=%s, cache_size=%sMB, "
+            "mmap_size=%sMB, temp_store=%s, busy_timeout=%sms"
+            % (mode, synchronous, cache_size, mmap_size, temp_store, busy_timeout)
+        )
+
+    def migrate(self):
+        """
+        Applies all schema migrations newer than the database's version
+        in one transaction
+        :return:
+        """
+        with self.ops() as cur:
+            cur.execute("PRAGMA user_version")
+            version = cur.fetchone()[0]
+            if version >= len(MIGRATIONS):
+                logger.debug("Database schema is up to date (v%s)." % version)
+                return
+            for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info("Migrating database schema to v%s ..." % target)
+                migration(cur)
+            cur.execute("PRAGMA user_version = %d" % len(MIGRATIONS))
+
+    def rebuild_stats(self):
+        logger.info("Rebuilding monthly user statistics ...")
+        with self.ops() as cur:
+            rebuild_user_month_stats(cur)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Opens a transaction scope on the shared connection. The outermost
+        scope issues BEGIN/COMMIT, nested scopes use savepoints so a failing
+        inner block only rolls back its own statements.
+        :return:
+        """
+        with self._lock:
+            self._depth += 1
+            savepoint = "sp_%d" % self._depth
+            if self._depth == 1:
+                self.con.execute("BEGIN")
+                changes = self.con.total_changes
+            else:
+                self.con.execute("SAVEPOINT %s" % savepoint)
             try:
-                cur.execute("SELECT tmdb_id FROM movies LIMIT 1")
-            except sqlite3.OperationalError:
-                logger.info("Column 'tmdb_id' not found in table. Adding column ...")
-                cur.execute("ALTER TABLE movies ADD COLUMN tmdb_id INTEGER")
-            # ---
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS monthly(
-                    monthly_id INTEGER PRIMARY KEY,
-                    month INTEGER NOT NULL,
-                    year INTEGER NOT NULL,
-                    notified INTEGER NOT NULL
-                )
-            """
-            )
-            # ---
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS tmdb(
-                    tmdb_id INTEGER PRIMARY KEY,
-                    imdb_id INTEGER,
-                    release_date TEXT,
-                    runtime INTEGER,
-                    letterboxd_avg REAL,
-                    letterboxd_avg_date TEXT,
-                    shortfilm INTEGER GENERATED ALWAYS AS (CASE WHEN runtime < 40 THEN 1 ELSE 0 END),
-                    title TEXT NOT NULL
-                )"""
-            )
-            # ---
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS yearly(
-                    yearly_id INTEGER PRIMARY KEY,
-                    year INTEGER NOT NULL,
-                    notified INTEGER NOT NULL
-                )
-                """
-            )
+                yield self
+            except BaseException:
+                if self._depth == 1:
+                    self.con.execute("ROLLBACK")
+                    metrics.inc(
+                        "moviebob_db_rollbacks_total", stage=metrics.current_stage()
+                    )
+                else:
+                    self.con.execute("ROLLBACK TO %s" % savepoint)
+                    self.con.execute("RELEASE %s" % savepoint)
+                raise
+            else:
+                if self._depth == 1:
+                    self.con.execute("COMMIT")
+                    # Read-only scopes are not counted as commits
+                    if self.con.total_changes != changes:
+                        metrics.inc(
+                            "moviebob_db_commits_total", stage=metrics.current_stage()
+                        )
+                else:
+                    self.con.execute("RELEASE %s" % savepoint)
+            finally:
+                self._depth -= 1
 
     @contextmanager
     def ops(self):
-        con = sqlite3.connect(self.path)
-        cur = con.cursor()
-        yield cur
-        con.commit()
-        con.close()
+        with self.transaction():
+            cur = self.con.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def close(self):
+        with self._lock:
+            self.con.close()
 
 
 class User:
     def __init__(self, username, db, nickname=None):
         logger.debug(f"Creating user %s ..." % username)
         self.username = username
-        self.feed_url = f"https://letterboxd.com/%s/rss/" % username
+        self.feed_url = f"%s/%s/rss/" % (client.LETTERBOXD_URL, username)
         if nickname is None:
             self.nickname = username
         else:
@@ -102,8 +547,9 @@ class User:
         with self.db.ops() as c:
             c.execute(
                 """
-                 INSERT or IGNORE into users(username, nickname, feed_url)
+                 INSERT into users(username, nickname, feed_url)
                  VALUES (?, ?, ?)
+                 ON CONFLICT(username) DO UPDATE SET nickname = excluded.nickname
             """,
                 (self.username, self.nickname, self.feed_url),
             )
@@ -112,18 +558,55 @@ class User:
             try:
                 c.execute(
                     """
-                    SELECT user_id
+                    SELECT user_id, feed_etag, feed_modified, last_letterboxd_id, last_published
                     FROM users
                     WHERE username is ?
                 """,
                     (self.username,),
                 )
-                self.user_id = c.fetchone()[0]
+                (
+                    self.user_id,
+                    self.feed_etag,
+                    self.feed_modified,
+                    self.last_letterboxd_id,
+                    self.last_published,
+                ) = c.fetchone()
             except BaseException as e:
                 logger.error(e)
                 logger.error(f"Creation of user '%s' failed. Exiting..." % username)
                 exit(1)
 
+    def save_feed_state(self, etag, modified, last_letterboxd_id, last_published):
+        """
+        Remembers the ETag and Last-Modified header of the last fetched feed,
+        so the next request can be sent conditionally, and the newest entry
+        already ingested, so parsing can stop there next time
+        :param etag:
+        :param modified:
+        :param last_letterboxd_id:
+        :param last_published:
+        :return:
+        """
+        self.feed_etag = etag
+        self.feed_modified = modified
+        self.last_letterboxd_id = last_letterboxd_id
+        self.last_published = last_published
+        with self.db.ops() as c:
+            c.execute(
+                """
+                UPDATE users
+                SET feed_etag = ?, feed_modified = ?, last_letterboxd_id = ?, last_published = ?
+                WHERE user_id = ?
+            """,
+                (
+                    self.feed_etag,
+                    self.feed_modified,
+                    self.last_letterboxd_id,
+                    self.last_published,
+                    self.user_id,
+                ),
+            )
+
 
 class Movie:
     def __init__(
@@ -189,6 +672,28 @@ class Movie:
                 exit(1)
 
 
+def save_movies(db, movie_rows):
+    """
+    Persists many movies in one statement. Rows are tuples in the column order
+    (letterboxd_id, tmdb_id, url, title, year, rating, rewatch, date, user,
+    notified); entries already known by their letterboxd_id are skipped.
+    :param db:
+    :param movie_rows:
+    :return: number of newly inserted movies
+    """
+    with db.ops() as c:
+        c.executemany(
+            """
+            INSERT INTO movies(letterboxd_id, tmdb_id, url, title, year, rating, rewatch, date, user, notified)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(letterboxd_id) DO NOTHING
+        """,
+            movie_rows,
+        )
+        # Unlike total_changes this leaves out rows written by triggers
+        return max(c.rowcount, 0)
+
+
 class TMDB:
     def __init__(
         self,
@@ -200,6 +705,8 @@ class TMDB:
         runtime=None,
         letterboxd_avg=0.0,
         letterboxd_avg_date="0",
+        letterboxd_avg_due="0",
+        slug=None,
     ):
         self.tmdb_id = tmdb_id
         self.db = db
@@ -209,12 +716,14 @@ class TMDB:
         self.runtime = runtime
         self.letterboxd_avg = letterboxd_avg
         self.letterboxd_avg_date = letterboxd_avg_date
+        self.letterboxd_avg_due = letterboxd_avg_due
+        self.slug = slug
 
         with self.db.ops() as c:
             c.execute(
                 """
-                INSERT or IGNORE into tmdb(tmdb_id, imdb_id, title, release_date, runtime, letterboxd_avg, letterboxd_avg_date)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
+                INSERT or IGNORE into tmdb(tmdb_id, imdb_id, title, release_date, runtime, letterboxd_avg, letterboxd_avg_date, letterboxd_avg_due, slug)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
                 (
                     self.tmdb_id,
@@ -224,8 +733,16 @@ class TMDB:
                     self.runtime,
                     self.letterboxd_avg,
                     self.letterboxd_avg_date,
+                    self.letterboxd_avg_due,
+                    self.slug,
                 ),
             )
+            if self.slug is not None:
+                # Entries created before the slug was stored
+                c.execute(
+                    "UPDATE tmdb SET slug = ? WHERE tmdb_id = ? AND slug IS NULL",
+                    (self.slug, self.tmdb_id),
+                )
 
         with self.db.ops() as c:
             try:
@@ -244,3 +761,223 @@ class TMDB:
                     f"Creation of tmdb entry '%s' failed. Exiting..." % self.title
                 )
                 exit(1)
+
+
+class UserStats(NamedTuple):
+    """
+    Aggregated watch statistics of one user within a date range
+    """
+
+    user_id: int
+    nickname: str
+    watch_count: int
+    rewatch_count: int
+    shortfilm_count: int
+    # Number of watches with TMDB details, runtime and average need them
+    tmdb_count: int
+    runtime_sum: int
+    letterboxd_avg: Optional[float]
+
+
+def fetch_user_stats(db, start, end):
+    """
+    Sums the monthly rollup of watches, rewatches, shortfilms, runtime and
+    letterboxd average per user over the date range
+    :param db:
+    :param start: first month included, e.g. `2024-01-01`
+    :param end: first month excluded, e.g. `2024-02-01`
+    :return: list of UserStats, most watches first
+    """
+    with db.ops() as c:
+        c.execute(
+            """
+            SELECT
+                user,
+                nickname,
+                SUM(watches),
+                SUM(rewatches),
+                SUM(shortfilms),
+                SUM(tmdb_count),
+                SUM(runtime_sum),
+                SUM(rating_sum) / NULLIF(SUM(rating_count), 0)
+            FROM user_month_stats
+            INNER JOIN users ON users.user_id = user_month_stats.user
+            WHERE month >= ? AND month < ?
+            GROUP BY user
+            HAVING SUM(watches) > 0
+            ORDER BY SUM(watches) DESC
+            """,
+            (start[:7], end[:7]),
+        )
+        return [UserStats(*row) for row in c.fetchall()]
+
+
+class Notification(NamedTuple):
+    """
+    Pending watch notification with everything needed to render it
+    """
+
+    movie_id: int
+    title: str
+    url: str
+    rewatch: int
+    nickname: str
+    runtime: Optional[int]
+    letterboxd_avg: Optional[float]
+    shortfilm: Optional[int]
+
+
+def fetch_pending_notifications(db, user_ids, movie_ids=None):
+    """
+    Returns all movies of the given users not notified yet, oldest first
+    :param db:
+    :param user_ids:
+    :param movie_ids: optionally only these movies
+    :return: list of Notification
+    """
+    user_ids = list(user_ids)
+    params = list(user_ids)
+    movie_filter = ""
+    if movie_ids is not None:
+        movie_ids = list(movie_ids)
+        movie_filter = "AND movie_id IN (%s)" % ", ".join("?" * len(movie_ids))
+        params.extend(movie_ids)
+    with db.ops() as c:
+        c.execute(
+            """
+            SELECT
+                movie_id,
+                movies.title,
+                url,
+                rewatch,
+                nickname,
+                runtime,
+                letterboxd_avg,
+                shortfilm
+            FROM movies
+            INNER JOIN users ON users.user_id = movies.user
+            LEFT JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
+            WHERE notified = 0 AND user IN (%s) %s
+            ORDER BY date, movie_id
+            """
+            % (", ".join("?" * len(user_ids)), movie_filter),
+            params,
+        )
+        return [Notification(*row) for row in c.fetchall()]
+
+
+class OutboxMessage(NamedTuple):
+    """
+    Rendered telegram message waiting in the outbox
+    """
+
+    id: int
+    chat_id: str
+    kind: str
+    text: str
+    attempts: int
+    # Run that claimed the message, only it may change the row
+    claimed_by: str
+
+
+# Outbox rows are claimed by one run at a time, other processes skip them
+# until the lease expired
+OUTBOX_OWNER = "%s-%s" % (os.getpid(), uuid.uuid4().hex[:8])
+OUTBOX_LEASE = 3600
+
+
+def queue_message(cur, chat_id, kind, dedupe_key, text, movie_ids=()):
+    """
+    Stores a rendered message in the outbox unless one with the same
+    `dedupe_key` exists already
+    :param cur:
+    :param chat_id:
+    :param kind: `movie`, `digest`, `monthly` or `yearly`
+    :param dedupe_key: e.g. `movie:42` or `monthly:2024-05`
+    :param text:
+    :param movie_ids: movies covered by the message
+    :return: True if the message got queued
+    """
+    cur.execute(
+        """
+        INSERT INTO outbox(dedupe_key, chat_id, kind, text, movie_ids)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(dedupe_key) DO NOTHING
+    """,
+        (dedupe_key, str(chat_id), kind, text, json.dumps(list(movie_ids))),
+    )
+    return cur.rowcount == 1
+
+
+def fetch_due_messages(db, owner=OUTBOX_OWNER, lease=OUTBOX_LEASE):
+    """
+    Claims the outbox messages due for delivery and returns them, oldest
+    first. Messages claimed by another run are skipped until its lease
+    expired. Messages left in `sending` by a run whose lease expired may
+    have reached telegram already and are marked sent instead of being
+    posted twice.
+    :param db:
+    :param owner: identifies the claiming run
+    :param lease: seconds a claim stays valid
+    :return: list of OutboxMessage
+    """
+    expired = "-%d seconds" % lease
+    with db.ops() as c:
+        c.execute(
+            """
+            SELECT id FROM outbox
+            WHERE status = 'sending' AND claimed_at < datetime('now', ?)
+        """,
+            (expired,),
+        )
+        for (message_id,) in c.fetchall():
+            logger.warning(
+                "Outbox message %s was interrupted while sending, assuming it got delivered."
+                % message_id
+            )
+            c.execute(
+                """
+                UPDATE outbox
+                SET status = 'sent', sent_at = datetime('now'),
+                    last_error = 'Interrupted while sending', claimed_by = NULL
+                WHERE id = ? AND status = 'sending'
+            """,
+                (message_id,),
+            )
+        c.execute(
+            """
+            SELECT id
+            FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= datetime('now')
+            AND (claimed_by IS NULL OR claimed_at < datetime('now', ?))
+            ORDER BY id
+        """,
+            (expired,),
+        )
+        claimed = []
+        for (message_id,) in c.fetchall():
+            # Another process may have claimed the row meanwhile
+            c.execute(
+                """
+                UPDATE outbox
+                SET claimed_by = ?, claimed_at = datetime('now')
+                WHERE id = ? AND status = 'pending'
+                AND (claimed_by IS NULL OR claimed_at < datetime('now', ?))
+            """,
+                (owner, message_id, expired),
+            )
+            if c.rowcount == 1:
+                claimed.append(message_id)
+        if not claimed:
+            return []
+        c.execute(
+            """
+            SELECT id, chat_id, kind, text, attempts, claimed_by
+            FROM outbox
+            WHERE id IN (%s)
+            ORDER BY id
+        """
+            % ", ".join("?" * len(claimed)),
+            claimed,
+        )
+        return [OutboxMessage(*row) for row in c.fetchall()]
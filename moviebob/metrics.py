@@ -0,0 +1,220 @@
+import os
+import json
+import tempfile
+import threading
+from time import monotonic
+from datetime import datetime
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets in seconds
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+# Innermost stage of the current thread, used to attribute work to stages
+_local = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Adds `value` to a counter
+    :param name: e.g. `moviebob_http_requests_total`
+    :param value:
+    :param labels:
+    :return:
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=HTTP_BUCKETS, **labels):
+    """
+    Records a value in a histogram
+    :param name: e.g. `moviebob_http_request_duration_seconds`
+    :param value:
+    :param buckets: upper bounds, fixed by the first observation
+    :param labels:
+    :return:
+    """
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = {
+                "buckets": tuple(buckets),
+                "counts": [0] * len(buckets),
+                "sum": 0.0,
+                "count": 0,
+            }
+        histogram = _histograms[key]
+        for i, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][i] += 1
+                break
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def current_stage():
+    return getattr(_local, "stage", "none")
+
+
+@contextmanager
+def attribute_to(name):
+    """
+    Attributes the work of the calling thread to a stage without counting
+    another run of it, e.g. in worker threads of a stage
+    :param name: usually `current_stage()` of the thread handing out the work
+    :return:
+    """
+    outer = current_stage()
+    _local.stage = name
+    try:
+        yield
+    finally:
+        _local.stage = outer
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures the duration of a stage, failed runs are counted separately.
+    Requests and commits of the calling thread are attributed to it.
+    :param name:
+    :return:
+    """
+    started = monotonic()
+    outcome = "error"
+    outer = current_stage()
+    _local.stage = name
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        _local.stage = outer
+        observe(
+            "moviebob_stage_duration_seconds",
+            monotonic() - started,
+            buckets=STAGE_BUCKETS,
+            stage=name,
+        )
+        inc("moviebob_stage_runs_total", stage=name, outcome=outcome)
+
+
+def snapshot():
+    """
+    Copies every metric into plain data
+    :return: dict with `counters` and `histograms`
+    """
+    with _lock:
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_counters.items())
+        ]
+        histograms = []
+        for (name, labels), histogram in sorted(_histograms.items()):
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            buckets["+Inf"] = histogram["count"]
+            histograms.append(
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": buckets,
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                }
+            )
+    return {
+        "generated_at": datetime.now().isoformat(),
+        "counters": counters,
+        "histograms": histograms,
+    }
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in items
+    )
+
+
+def prometheus_text(data):
+    """
+    Renders a snapshot in the Prometheus text exposition format
+    :param data: result of `snapshot`
+    :return:
+    """
+    lines = []
+    typed = set()
+    for counter in data["counters"]:
+        if counter["name"] not in typed:
+            lines.append("# TYPE %s counter" % counter["name"])
+            typed.add(counter["name"])
+        lines.append(
+            "%s%s %s" % (counter["name"], _labels(counter["labels"]), counter["value"])
+        )
+    for histogram in data["histograms"]:
+        name = histogram["name"]
+        if name not in typed:
+            lines.append("# TYPE %s histogram" % name)
+            typed.add(name)
+        for bound, count in histogram["buckets"].items():
+            lines.append(
+                "%s_bucket%s %s"
+                % (name, _labels(histogram["labels"], {"le": bound}), count)
+            )
+        lines.append("%s_sum%s %s" % (name, _labels(histogram["labels"]), histogram["sum"]))
+        lines.append(
+            "%s_count%s %s" % (name, _labels(histogram["labels"]), histogram["count"])
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path, content):
+    # Readers like the textfile collector never see a half written file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".moviebob-metrics-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def export(json_path=None, prometheus_path=None):
+    """
+    Writes the current metrics to the given files
+    :param json_path:
+    :param prometheus_path: e.g. `<textfile dir>/moviebob.prom`
+    :return:
+    """
+    if not json_path and not prometheus_path:
+        return
+    data = snapshot()
+    if json_path:
+        _write_atomic(json_path, json.dumps(data, indent=2))
+    if prometheus_path:
+        _write_atomic(prometheus_path, prometheus_text(data))
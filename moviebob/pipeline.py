@@ -0,0 +1,291 @@
+import queue
+import threading
+from logzero import logger
+from urllib.parse import urlparse
+from moviebob import client
+from moviebob import helper
+from moviebob import metrics
+from moviebob import poller
+from moviebob import ratelimit
+from moviebob import telegram
+
+
+class Stopped(Exception):
+    """
+    Raised by the pause hook to abort maintenance when the pipeline stops
+    """
+
+
+class Pipeline:
+    """
+    Moves every new movie through ingest, id resolution, TMDB enrichment and
+    notification as soon as it shows up. Each stage runs in its own threads
+    and hands work to the next one through a bounded queue, so a full queue
+    slows down the stages in front of it. Maintenance tasks run in a
+    separate thread and only make progress while the pipeline is idle.
+    """
+
+    def __init__(
+        self,
+        db,
+        user_list,
+        dispatcher,
+        chat_id,
+        api_key,
+        feed_workers=8,
+        host_limit=4,
+        tmdb_workers=8,
+        tmdb_rate=40,
+        response_cache=None,
+        digest_threshold=0,
+        queue_size=100,
+    ):
+        self.db = db
+        self.user_list = user_list
+        self.dispatcher = dispatcher
+        self.chat_id = chat_id
+        self.tmdb = client.tmdb(api_key)
+        self.limiter = ratelimit.TokenBucket(tmdb_rate)
+        self.response_cache = response_cache
+        self.digest_threshold = digest_threshold
+        self.host_limit = max(1, host_limit)
+        self.host_limits = {}
+        # Films resolved by this pipeline, later entries skip the film page
+        self.films = {}
+        # One lookup per film at a time, concurrent entries wait for it
+        self.film_locks = {}
+        self.lock = threading.Lock()
+
+        self.ingest_queue = queue.Queue(queue_size)
+        self.resolve_queue = queue.Queue(queue_size)
+        self.details_queue = queue.Queue(queue_size)
+        self.notify_queue = queue.Queue(queue_size)
+        self.maintenance_queue = queue.Queue()
+        self.maintenance = set()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.stages = [
+            (self.ingest_queue, self.ingest, max(1, feed_workers)),
+            (self.resolve_queue, self.resolve, self.host_limit),
+            (self.details_queue, self.details, max(1, tmdb_workers)),
+            (self.notify_queue, self.notify, 1),
+        ]
+
+    def start(self):
+        for work_queue, handler, workers in self.stages:
+            for i in range(workers):
+                self._start_thread(
+                    "%s-%s" % (handler.__name__, i), self._work, work_queue, handler
+                )
+        self._start_thread("maintenance", self._maintain)
+
+    def _start_thread(self, name, target, *args):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _work(self, work_queue, handler):
+        while True:
+            item = work_queue.get()
+            try:
+                if item is None:
+                    return
+                with metrics.stage("pipeline_%s" % handler.__name__):
+                    handler(item)
+            except Exception as err:
+                logger.exception(
+                    "Pipeline stage '%s' failed on %s: %s" % (handler.__name__, item, err)
+                )
+            finally:
+                work_queue.task_done()
+
+    def busy(self):
+        return any(
+            work_queue.unfinished_tasks for work_queue, _, _ in self.stages
+        )
+
+    def wait_idle(self):
+        # Pause hook for maintenance, user facing work always goes first
+        while self.busy() and not self.stop_event.is_set():
+            self.stop_event.wait(0.2)
+        if self.stop_event.is_set():
+            raise Stopped()
+
+    def ingest_feeds(self):
+        """
+        Queues a feed download for every user
+        :return:
+        """
+        for user in self.user_list.values():
+            self.ingest_queue.put(user)
+
+    def ingest_pending(self):
+        """
+        Queues movies left pending by earlier runs
+        :return:
+        """
+        with self.db.ops() as c:
+            c.execute(
+                """
+                SELECT movie_id, title, url, tmdb_id
+                FROM movies
+                WHERE notified = 0
+                ORDER BY date, movie_id
+            """
+            )
+            movies = c.fetchall()
+        for movie in movies:
+            self.resolve_queue.put(movie)
+
+    def ingest(self, user: helper.User):
+        netloc = urlparse(user.feed_url).netloc
+        with self.lock:
+            if netloc not in self.host_limits:
+                self.host_limits[netloc] = threading.BoundedSemaphore(self.host_limit)
+        result = poller.fetch_user_movies(self.db, user, self.host_limits)
+        if result is None:
+            return
+        saved, letterboxd_ids = result
+        metrics.inc("moviebob_movies_ingested_total", saved)
+        with self.db.ops() as c:
+            c.execute(
+                """
+                SELECT movie_id, title, url, tmdb_id
+                FROM movies
+                WHERE notified = 0 AND letterboxd_id IN (%s)
+                ORDER BY date, movie_id
+            """
+                % ", ".join("?" * len(letterboxd_ids)),
+                letterboxd_ids,
+            )
+            movies = c.fetchall()
+        for movie in movies:
+            self.resolve_queue.put(movie)
+
+    def resolve(self, movie):
+        movie_id, title, url, tmdb_id = movie
+        if not tmdb_id:
+            slug = helper.film_slug(url)
+            with self.lock:
+                film_lock = self.film_locks.setdefault(slug, threading.Lock())
+            with film_lock:
+                with self.lock:
+                    tmdb_id = self.films.get(slug)
+                if tmdb_id is None:
+                    tmdb_id = poller.resolve_film(self.db, slug, title, [url])
+                    # A failed lookup is retried by the next entry of the film
+                    if tmdb_id:
+                        with self.lock:
+                            self.films[slug] = tmdb_id
+                else:
+                    with self.db.ops() as c:
+                        c.execute(
+                            "UPDATE movies SET tmdb_id = ? WHERE movie_id = ?",
+                            (tmdb_id, movie_id),
+                        )
+        self.details_queue.put((movie_id, title, tmdb_id))
+
+    def details(self, movie):
+        movie_id, title, tmdb_id = movie
+        if tmdb_id:
+            with self.db.ops() as c:
+                c.execute(
+                    """
+                    SELECT tmdb_id FROM tmdb
+                    WHERE tmdb_id = ?
+                    AND (imdb_id is null OR release_date is null OR runtime is null)
+                """,
+                    (tmdb_id,),
+                )
+                incomplete = c.fetchone() is not None
+            if incomplete:
+                update = poller.fetch_tmdb_details(
+                    self.tmdb, self.limiter, tmdb_id, title, self.response_cache
+                )
+                if update is not None:
+                    poller.save_tmdb_details(self.db, [update])
+        self.notify_queue.put(movie_id)
+
+    def notify(self, movie_id):
+        # Take everything that arrived meanwhile, so backlogs can be digested
+        movie_ids = [movie_id]
+        while True:
+            try:
+                movie_id = self.notify_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.notify_queue.task_done()
+            if movie_id is None:
+                # Keep the stop signal for the loop
+                self.notify_queue.put(None)
+                break
+            movie_ids.append(movie_id)
+        telegram.queue_movie_updates(
+            self.db,
+            self.chat_id,
+            self.user_list,
+            digest_threshold=self.digest_threshold,
+            movie_ids=movie_ids,
+        )
+        telegram.drain_outbox(self.db, self.dispatcher)
+
+    def maintain(self, name, func):
+        """
+        Queues a low priority task unless it is queued or running already
+        :param name:
+        :param func: called with a pause callable that blocks while the
+                     pipeline has work
+        :return:
+        """
+        with self.lock:
+            if name in self.maintenance:
+                logger.debug("Maintenance '%s' already queued. Skipping ..." % name)
+                return
+            self.maintenance.add(name)
+        self.maintenance_queue.put((name, func))
+
+    def _maintain(self):
+        while True:
+            task = self.maintenance_queue.get()
+            try:
+                if task is None:
+                    return
+                name, func = task
+                self.wait_idle()
+                logger.debug("Running maintenance '%s' ..." % name)
+                with metrics.stage("maintenance_%s" % name):
+                    func(self.wait_idle)
+            except Stopped:
+                logger.info("Maintenance '%s' aborted." % task[0])
+            except Exception as err:
+                logger.exception("Maintenance '%s' failed: %s" % (task[0], err))
+            finally:
+                if task is not None:
+                    with self.lock:
+                        self.maintenance.discard(task[0])
+                self.maintenance_queue.task_done()
+
+    def join(self):
+        """
+        Waits until every queued movie went through all stages
+        :return:
+        """
+        for work_queue, _, _ in self.stages:
+            work_queue.join()
+
+    def stop(self, finish_maintenance=True):
+        """
+        Finishes queued work and stops all threads
+        :param finish_maintenance: otherwise maintenance gets aborted
+        :return:
+        """
+        self.join()
+        if finish_maintenance:
+            self.maintenance_queue.join()
+        self.stop_event.set()
+        for work_queue, _, workers in self.stages:
+            for i in range(workers):
+                work_queue.put(None)
+        self.maintenance_queue.put(None)
+        for thread in self.threads:
+            thread.join()
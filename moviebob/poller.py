@@ -1,15 +1,20 @@
+import json
+import codecs
+import random
+import hashlib
 import requests
 import feedparser
-from bs4 import BeautifulSoup
 from logzero import logger
+from moviebob import cache
+from moviebob import client
 from moviebob import helper
-from datetime import datetime
+from moviebob import metrics
+from moviebob import ratelimit
+from datetime import datetime, timedelta
 from time import mktime
-
-headers = {
-    "referer": "https://letterboxd.com",
-    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-}
+from urllib.parse import urlparse
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 def setup_users(user_list, db):
@@ -20,33 +25,75 @@ def setup_users(user_list, db):
     :return:
     """
     parsed_user_list = {}
-    for user in user_list:
-        parsed_string = user.split(":")
-        parsed_user = ""
-        if len(parsed_string) == 1:
-            parsed_user = helper.User(username=parsed_string[0], db=db)
-        elif len(parsed_string) == 2:
-            parsed_user = helper.User(
-                username=parsed_string[0], nickname=parsed_string[1], db=db
-            )
-        else:
-            logger.error(
-                f"Could not parse provided user string '%s'. Need format 'username:nickname'! Exiting ..."
-                % user
-            )
-            exit(1)
-        parsed_user_list[parsed_user.username] = parsed_user
+    with db.transaction():
+        for user in user_list:
+            parsed_string = user.split(":")
+            parsed_user = ""
+            if len(parsed_string) == 1:
+                parsed_user = helper.User(username=parsed_string[0], db=db)
+            elif len(parsed_string) == 2:
+                parsed_user = helper.User(
+                    username=parsed_string[0], nickname=parsed_string[1], db=db
+                )
+            else:
+                logger.error(
+                    f"Could not parse provided user string '%s'. Need format 'username:nickname'! Exiting ..."
+                    % user
+                )
+                exit(1)
+            parsed_user_list[parsed_user.username] = parsed_user
     return parsed_user_list
 
 
-def fetch_letterboxd_avg(soup, fullUrl):
+class FilmPageParser(HTMLParser):
+    """
+    Minimal parser for letterboxd film pages. It only looks at start tags
+    and is done at <body>, which carries the tmdb id. The rating meta tag
+    always comes before it in the head.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.tmdb_id = None
+        self.rating = None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "meta":
+            attrs = dict(attrs)
+            if attrs.get("name") == "twitter:data2":
+                self.rating = attrs.get("content")
+        elif tag == "body":
+            self.tmdb_id = dict(attrs).get("data-tmdb-id")
+            self.done = True
+
+
+def fetch_film_meta(fullUrl):
+    """
+    Streams a letterboxd film page and stops parsing as soon as the tmdb id
+    and the rating are found, without building a document tree
+    :param fullUrl:
+    :return: FilmPageParser holding `tmdb_id` and `rating`
+    """
+    parser = FilmPageParser()
+    with client.letterboxd().get(fullUrl, stream=True) as resp:
+        resp.raise_for_status()
+        decoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")("replace")
+        chunks = resp.iter_content(chunk_size=16 * 1024)
+        for chunk in chunks:
+            parser.feed(decoder.decode(chunk))
+            if parser.done:
+                break
+        # Read the rest without parsing, so the connection can be reused
+        for chunk in chunks:
+            pass
+    return parser
+
+
+def fetch_letterboxd_avg(parser: FilmPageParser, fullUrl):
     # Average rating from website parsing (probably brakes one day)
     try:
-        letterboxdAvg = float(
-            soup.find("meta", attrs={"name": "twitter:data2"})
-            .attrs["content"]
-            .split(" ")[0]
-        )
+        letterboxdAvg = float(parser.rating.split(" ")[0])
         logger.debug("Parsed average rating '%s' from '%s'." % (letterboxdAvg, fullUrl))
         return letterboxdAvg
     except Exception as e:
@@ -54,125 +101,227 @@ def fetch_letterboxd_avg(soup, fullUrl):
         return 0
 
 
-def update_letterboxd_avg(db: helper.DB):
-    logger.debug("Updating letterboxd average for every movie older than 30 days ...")
+# Bounds of the refresh interval in days, the more a film's average can
+# still move the more often it is checked. Checked top to bottom: films
+# watched within the last days, released within the last days (few ratings
+# yet) and then by release age.
+LETTERBOXD_AVG_INTERVALS = (
+    ("watched", 30, 1, 7),
+    ("released", 365, 3, 30),
+    ("released", 5 * 365, 14, 90),
+    ("released", None, 30, 365),
+)
+LETTERBOXD_AVG_JITTER = 0.2
+
+
+def letterboxd_avg_interval(last_interval, changed, last_watch, release_date, now):
+    """
+    Days until the next refresh of a film's average. Unchanged averages
+    double the interval up to the upper bound of the film's class, a change
+    resets it to the lower bound.
+    :param last_interval: interval of the last refresh, None for new films
+    :param changed: whether the last refresh changed the average
+    :param last_watch: date of the latest watch, e.g. `2024-03-01T20:00:00`
+    :param release_date: e.g. `2024-02-23`
+    :param now:
+    :return: interval in days
+    """
+    for kind, days, low, high in LETTERBOXD_AVG_INTERVALS:
+        since = last_watch if kind == "watched" else release_date
+        if days is None:
+            break
+        if since and since >= (now - timedelta(days=days)).isoformat():
+            break
+    if changed or not last_interval:
+        return low
+    return min(max(last_interval * 2, low), high)
+
+
+def letterboxd_avg_due(interval, now):
+    # Jitter keeps films refreshed on the same night from staying together
+    jitter = random.uniform(1 - LETTERBOXD_AVG_JITTER, 1 + LETTERBOXD_AVG_JITTER)
+    return (now + timedelta(days=interval * jitter)).isoformat(timespec="seconds")
+
+
+def update_letterboxd_avg(db: helper.DB, pause=None, budget=500):
+    """
+    Refreshes the letterboxd average of the films due, most overdue first
+    and at most `budget` film pages per run. Every film is committed on its
+    own, so the refresh never holds the database for long.
+    :param db:
+    :param pause: optional callable, blocks while more urgent work is queued
+    :param budget: film pages requested at most, films left over stay due
+    :return:
+    """
+    now = datetime.now()
+    logger.debug("Updating letterboxd average for up to %s due films ..." % budget)
     movie_list = []
     with db.ops() as c:
+        # One pass over the due index, the slug was stored at ingest
         c.execute(
             """
-            SELECT title, tmdb_id, letterboxd_avg
+            SELECT
+                tmdb_id,
+                slug,
+                letterboxd_avg,
+                title,
+                letterboxd_avg_interval,
+                release_date,
+                (SELECT MAX(date) FROM movies WHERE movies.tmdb_id = tmdb.tmdb_id)
             FROM tmdb
-            WHERE date(letterboxd_avg_date) <= date('now', '-30 day')
-        """
+            WHERE letterboxd_avg_due <= ? AND tmdb_id != 0 AND slug IS NOT NULL
+            ORDER BY letterboxd_avg_due
+            LIMIT ?
+        """,
+            (now.isoformat(timespec="seconds"), budget),
         )
         movie_list = c.fetchall()
 
+    refreshed = 0
     for movie in movie_list:
-        title = movie[0]
-        tmdbId = movie[1]
-        letterboxdAvg = movie[2]
-        fullUrl = ""
+        tmdbId, slug, letterboxdAvg, title, lastInterval, releaseDate, lastWatch = movie
+        if pause is not None:
+            pause()
 
         try:
-            # Get letterboxd url from different table
-            with db.ops() as c:
-                c.execute(
-                    "SELECT url, rewatch FROM movies WHERE tmdb_id = ?", (tmdbId,)
-                )
-                e = c.fetchone()
-                urlList = e[0].split("/")
-                # Remove empty fields from list
-                urlList = list(filter(None, urlList))
-                # If rewatch, a number is added to the url
-                if e[1]:
-                    fullUrl = "https://letterboxd.com/film/" + urlList[-2]
-                else:
-                    fullUrl = "https://letterboxd.com/film/" + urlList[-1]
-
+            fullUrl = film_url(slug)
             logger.debug("Using fullUrl: '%s'" % fullUrl)
-            soup = BeautifulSoup(
-                requests.get(fullUrl, headers=headers).content,
-                "html.parser",
-            )
-            letterboxdAvgNew = fetch_letterboxd_avg(soup, fullUrl)
-            if letterboxdAvg != letterboxdAvgNew:
+            meta = fetch_film_meta(fullUrl)
+            letterboxdAvgNew = fetch_letterboxd_avg(meta, fullUrl)
+            changed = letterboxdAvg != letterboxdAvgNew
+            if changed:
                 logger.debug(
                     "Letterboxd average changed for '%s' from %s to %s"
                     % (title, letterboxdAvg, letterboxdAvgNew)
                 )
             else:
                 logger.debug("Letterboxd average did not change for '%s'" % title)
+            interval = letterboxd_avg_interval(
+                lastInterval, changed, lastWatch, releaseDate, now
+            )
             # Update row regardless to update timestamp
             timestamp = datetime.now().isoformat()
             with db.ops() as c:
                 c.execute(
-                    "UPDATE tmdb SET letterboxd_avg = ?, letterboxd_avg_date = ? WHERE tmdb_id = ?",
-                    (letterboxdAvgNew, timestamp, tmdbId),
+                    """
+                    UPDATE tmdb
+                    SET letterboxd_avg = ?, letterboxd_avg_date = ?, letterboxd_avg_due = ?, letterboxd_avg_interval = ?
+                    WHERE tmdb_id = ?
+                """,
+                    (
+                        letterboxdAvgNew,
+                        timestamp,
+                        letterboxd_avg_due(interval, now),
+                        interval,
+                        tmdbId,
+                    ),
                 )
+            refreshed += 1
         except Exception as e:
             logger.warning(
                 "Failed to update letterboxd average for '%s': %s" % (title, e)
             )
+            # Retry in a later run instead of blocking the front of the queue
+            with db.ops() as c:
+                c.execute(
+                    "UPDATE tmdb SET letterboxd_avg_due = ? WHERE tmdb_id = ?",
+                    (letterboxd_avg_due(1, now), tmdbId),
+                )
             continue
-    logger.info("Updated all letterboxd average ratings.")
 
+    with db.ops() as c:
+        c.execute(
+            """
+            SELECT COUNT(*) FROM tmdb
+            WHERE letterboxd_avg_due <= ? AND tmdb_id != 0 AND slug IS NOT NULL
+        """,
+            (now.isoformat(timespec="seconds"),),
+        )
+        left = c.fetchone()[0]
+    logger.info(
+        "Updated %s letterboxd average ratings, %s films left for later runs."
+        % (refreshed, left)
+    )
+
+
+def film_url(slug):
+    return client.LETTERBOXD_URL + "/film/" + slug
 
-def fetch_movie_tmdb_ids(db: helper.DB):
+
+def fetch_movie_tmdb_ids(db: helper.DB, pause=None):
+    """
+    Looks up the tmdb id of every movie lacking one, once per film
+    :param db:
+    :param pause: optional callable, blocks while more urgent work is queued
+    :return:
+    """
     logger.debug("Starting to fetch tmdb IDs...")
     movie_list = []
     with db.ops() as c:
         c.execute(
-            "SELECT title, url, tmdb_id, rewatch FROM movies WHERE tmdb_id is 0 or tmdb_id is NULL"
+            "SELECT title, url FROM movies WHERE tmdb_id is 0 or tmdb_id is NULL"
         )
         movie_list = c.fetchall()
 
+    # Group by film, so every film page is requested only once per run
+    slug_list = {}
     for movie in movie_list:
-        title = movie[0]
-        url = movie[1]
-        tmdbId = movie[2]
-        rewatch = movie[3]
-        fullUrl = ""
-        letterboxdAvg = 0
-
-        logger.info("Parsing '%s' with url '%s'" % (title, url))
-
         try:
-            # Get fullUrl out of review url to save one webrequest
-            urlList = url.split("/")
-            # Remove empty fields from list
-            urlList = list(filter(None, urlList))
-            # Sometimes a number gets added to the last part of the url for rewatches, but not always...
-            rewatchUrl = False
-            try:
-                int(urlList[-1])
-                rewatchUrl = True
-            except ValueError:
-                rewatchUrl = False
-
-            if rewatchUrl:
-                fullUrl = "https://letterboxd.com/film/" + urlList[-2]
-            else:
-                fullUrl = "https://letterboxd.com/film/" + urlList[-1]
-            logger.debug("Using fullUrl: '%s'" % fullUrl)
-            soup = BeautifulSoup(
-                requests.get(fullUrl, headers=headers).content,
-                "html.parser",
-            )
-            # TMDB from META Tag
-            tmdbId = soup.find("body").attrs["data-tmdb-id"]
-            letterboxdAvg = fetch_letterboxd_avg(soup, fullUrl)
+            slug = helper.film_slug(movie[1])
         except Exception as e:
-            logger.warning(
-                "Were not able to webrequest meta infos for '%s': %s" % (title, e)
-            )
+            logger.warning("Could not parse film of url '%s': %s" % (movie[1], e))
+            continue
+        slug_list.setdefault(slug, []).append(movie)
 
-        try:
-            # On success write meta infos to database
-            timestamp = datetime.now().isoformat()
+    # Every film is committed on its own, the database stays usable for
+    # other threads while film pages are downloaded
+    for slug, movies in slug_list.items():
+        if pause is not None:
+            pause()
+        resolve_film(db, slug, movies[0][0], [movie[1] for movie in movies])
+    logger.debug("Fetched all missing tmdb IDs ...")
+
+
+def resolve_film(db: helper.DB, slug, title, urls):
+    """
+    Looks up the tmdb id and letterboxd average of a film once and writes
+    them to every entry of the film
+    :param db:
+    :param slug:
+    :param title:
+    :param urls: urls of all entries of the film
+    :return: tmdb id, 0 if the film page could not be parsed
+    """
+    fullUrl = film_url(slug)
+    tmdbId = 0
+    letterboxdAvg = 0
+
+    logger.info(
+        "Parsing '%s' with url '%s' for %s entries" % (title, fullUrl, len(urls))
+    )
+
+    try:
+        meta = fetch_film_meta(fullUrl)
+        # TMDB from body attribute
+        if meta.tmdb_id is None:
+            raise ValueError("No tmdb id found on film page")
+        tmdbId = meta.tmdb_id
+        letterboxdAvg = fetch_letterboxd_avg(meta, fullUrl)
+    except Exception as e:
+        logger.warning(
+            "Were not able to webrequest meta infos for '%s': %s" % (title, e)
+        )
+
+    try:
+        # On success write meta infos to all entries of the film, movies and
+        # tmdb entry in one transaction
+        now = datetime.now()
+        timestamp = now.isoformat()
+        with db.transaction():
             with db.ops() as c:
-                c.execute(
+                c.executemany(
                     "UPDATE movies SET tmdb_id = ? WHERE url = ?",
-                    (tmdbId, url),
+                    [(tmdbId, url) for url in urls],
                 )
             tmdb = helper.TMDB(
                 tmdb_id=tmdbId,
@@ -180,29 +329,88 @@ def fetch_movie_tmdb_ids(db: helper.DB):
                 title=title,
                 letterboxd_avg=letterboxdAvg,
                 letterboxd_avg_date=timestamp,
+                slug=slug,
+                # Just watched, so the average is checked again soon
+                letterboxd_avg_due=letterboxd_avg_due(
+                    letterboxd_avg_interval(None, True, timestamp, None, now), now
+                ),
             )
-            logger.info(
-                "Set id '%s' and rating '%s' for '%s'"
-                % (tmdb.tmdb_id, letterboxdAvg, title)
-            )
-        except Exception as err:
-            logger.error(
-                "Could not write informations of '%s' to database: %s" % (title, err)
-            )
-            continue
-    logger.debug("Fetched all missing tmdb IDs ...")
+        logger.info(
+            "Set id '%s' and rating '%s' for '%s'"
+            % (tmdb.tmdb_id, letterboxdAvg, title)
+        )
+    except Exception as err:
+        logger.error(
+            "Could not write informations of '%s' to database: %s" % (title, err)
+        )
+    return tmdbId
 
 
-def fetch_movie_tmdb_details(db: helper.DB, api_key: str):
-    headers = {"accept": "application/json", "Authorization": "Bearer %s" % api_key}
+def request_tmdb_movie(tmdb, limiter, tmdb_id, response_cache=None, attempts=3):
+    """
+    Requests the details of a movie from TMDB, served from the response
+    cache when possible. Every attempt takes a token from the shared
+    limiter, a rate limit response pauses the limiter for all workers as
+    long as TMDB asks via `Retry-After`.
+    :param tmdb: TMDB session
+    :param limiter: shared token bucket
+    :param tmdb_id:
+    :param response_cache: optional cache.ResponseCache
+    :param attempts:
+    :return: status code and json payload
+    """
+    path = "/3/movie/%s?language=en-US" % tmdb_id
+    if response_cache is not None:
+        body = response_cache.get("tmdb:" + path)
+        if body is not None:
+            logger.debug("Serving TMDB id '%s' from response cache." % tmdb_id)
+            return 200, json.loads(body)
 
-    # Test API key if valid
-    try:
-        resp = requests.get(
-            "https://api.themoviedb.org/3/authentication", headers=headers
+    for attempt in range(attempts):
+        limiter.acquire()
+        resp = tmdb.get(client.TMDB_URL + path)
+        if resp.status_code != 429:
+            break
+        try:
+            retry_after = float(resp.headers.get("Retry-After", 1))
+        except ValueError:
+            retry_after = 1
+        logger.info(
+            "TMDB rate limit hit for id '%s'. Pausing requests for %s seconds ..."
+            % (tmdb_id, retry_after)
         )
+        limiter.pause(retry_after)
+
+    payload = resp.json()
+    if resp.status_code == 200 and response_cache is not None:
+        # Complete details hardly change, unreleased movies still might
+        if payload.get("imdb_id") and payload.get("release_date") and payload.get("runtime"):
+            ttl = cache.TTL_MOVIE
+        else:
+            ttl = cache.TTL_MOVIE_INCOMPLETE
+        response_cache.set("tmdb:" + path, resp.content, ttl)
+    return resp.status_code, payload
+
+
+def validate_tmdb_api_key(api_key, response_cache=None):
+    """
+    Checks the TMDB api key and exits if it is not valid. A successful
+    validation is cached for a day.
+    :param api_key:
+    :param response_cache: optional cache.ResponseCache
+    :return:
+    """
+    key = "tmdb:/3/authentication:%s" % hashlib.sha256(api_key.encode()).hexdigest()
+    if response_cache is not None and response_cache.get(key) is not None:
+        logger.info("TMDB Api Key validated (cached).")
+        return
+
+    try:
+        resp = client.tmdb(api_key).get(client.TMDB_URL + "/3/authentication")
         if resp.status_code == 200:
             logger.info("TMDB Api Key validated.")
+            if response_cache is not None:
+                response_cache.set(key, resp.content, cache.TTL_AUTHENTICATION)
         else:
             logger.error(
                 "Status Code not 200 - TMDB Api Key '%s' could not be validated: %s"
@@ -222,6 +430,99 @@ def fetch_movie_tmdb_details(db: helper.DB, api_key: str):
         )
         exit(1)
 
+
+def save_tmdb_details(db: helper.DB, updates):
+    """
+    Writes a batch of fetched TMDB details back in one statement
+    :param db:
+    :param updates: tuples of (imdb_id, release_date, runtime, tmdb_id)
+    :return:
+    """
+    if not updates:
+        return
+    with db.ops() as c:
+        c.executemany(
+            """
+            UPDATE tmdb
+            SET imdb_id = ?, release_date = ?, runtime = ?
+            WHERE tmdb_id = ?
+            """,
+            updates,
+        )
+    logger.debug("Saved TMDB details of %s movies to database." % len(updates))
+
+
+def fetch_tmdb_details(tmdb, limiter, tmdb_id, title, response_cache=None):
+    """
+    Fetches the details of a single movie from TMDB
+    :param tmdb: TMDB session
+    :param limiter: shared token bucket
+    :param tmdb_id:
+    :param title: for logging
+    :param response_cache: optional cache.ResponseCache
+    :return: tuple of (imdb_id, release_date, runtime, tmdb_id) or None
+    """
+    try:
+        status_code, respJson = request_tmdb_movie(
+            tmdb, limiter, tmdb_id, response_cache
+        )
+        if status_code != 200:
+            logger.info(
+                "TMDB Error - Could not fetch informations for movie '%s' with id '%s': %s"
+                % (title, tmdb_id, respJson["status_message"])
+            )
+            return None
+
+        imdb_id = respJson.get("imdb_id", None)
+        release_date = respJson.get("release_date", None)
+        runtime = respJson.get("runtime", None)
+        logger.debug(
+            "Fetched movie '%s' with IMDB ID '%s', Release Date '%s' and Runtime of '%s'."
+            % (title, imdb_id, release_date, runtime)
+        )
+        return imdb_id, release_date, runtime, tmdb_id
+    except requests.RequestException as err:
+        logger.error(
+            "Requests Error - Could not fetch informations for movie '%s' with id '%s': %s"
+            % (title, tmdb_id, err)
+        )
+    except Exception as err:
+        logger.error(
+            "Unknown Error - Could not fetch informations for movie '%s' with id '%s': %s"
+            % (title, tmdb_id, err)
+        )
+    return None
+
+
+def fetch_movie_tmdb_details(
+    db: helper.DB,
+    api_key: str,
+    workers=8,
+    rate=40,
+    batch_size=50,
+    response_cache=None,
+    validate=True,
+    limiter=None,
+    pause=None,
+):
+    """
+    Fetches missing TMDB details for every movie in parallel, limited to
+    `rate` requests per second, and writes them back in batches
+    :param db:
+    :param api_key:
+    :param workers: number of requests in flight
+    :param rate: maximum requests per second
+    :param batch_size: number of movies saved per statement
+    :param response_cache: optional cache.ResponseCache
+    :param validate: check the api key first, long running callers do it once
+    :param limiter: TokenBucket shared with other TMDB clients, replaces `rate`
+    :param pause: optional callable, blocks while more urgent work is queued
+    :return:
+    """
+    tmdb = client.tmdb(api_key)
+    if validate:
+        validate_tmdb_api_key(api_key, response_cache)
+
     # If successfull continue to parse informations for each movie
     # lacking any required information.
     logger.debug("Starting to update missing TMDB movie details...")
@@ -236,112 +537,153 @@ def fetch_movie_tmdb_details(db: helper.DB, api_key: str):
         )
         movie_list = c.fetchall()
 
-    for movie in movie_list:
-        title = movie[0]
-        tmdb_id = movie[1]
+    if limiter is None:
+        limiter = ratelimit.TokenBucket(rate)
 
-        try:
-            resp = requests.get(
-                "https://api.themoviedb.org/3/movie/%s?language=en-US" % tmdb_id,
-                headers=headers,
-            )
-            if resp.status_code != 200:
-                logger.info(
-                    "TMDB Error - Could not fetch informations for movie '%s' with id '%s': %s"
-                    % (title, tmdb_id, resp.json()["status_message"])
-                )
+    # Worker threads don't inherit the stage of the caller
+    stage = metrics.current_stage()
+
+    def fetch(tmdb_id, title):
+        with metrics.attribute_to(stage):
+            if pause is not None:
+                pause()
+            return fetch_tmdb_details(tmdb, limiter, tmdb_id, title, response_cache)
+
+    updates = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(fetch, movie[1], movie[0]) for movie in movie_list]
+        for future in as_completed(futures):
+            update = future.result()
+            if update is None:
                 continue
+            updates.append(update)
 
-            respJson = resp.json()
-            imdb_id = respJson.get("imdb_id", None)
-            release_date = respJson.get("release_date", None)
-            runtime = respJson.get("runtime", None)
+            if len(updates) >= batch_size:
+                save_tmdb_details(db, updates)
+                updates = []
+    save_tmdb_details(db, updates)
+    logger.info("Finished fetching movie informations from TMDB.")
 
-            with db.ops() as c:
-                c.execute(
-                    """
-                    UPDATE tmdb
-                    SET imdb_id = ?, release_date = ?, runtime = ?
-                    WHERE tmdb_id = ?
-                    """,
-                    (imdb_id, release_date, runtime, tmdb_id),
+
+def feed_entry_date(entry):
+    return datetime.fromtimestamp(mktime(entry.published_parsed)).isoformat()
+
+
+def parse_feed_entries(feed, user: helper.User):
+    """
+    Converts the entries of a parsed rss feed into movie rows ready for
+    `helper.save_movies`. The feed is ordered newest-first, so parsing stops
+    at the first entry the user's high-water mark already covers.
+    :param feed:
+    :param user:
+    :return: list of movie row tuples
+    """
+    movie_rows = []
+    for e in feed.entries:
+        try:
+            if e.id == user.last_letterboxd_id or (
+                user.last_published is not None
+                and feed_entry_date(e) < user.last_published
+            ):
+                logger.debug("Reached already ingested entry. Stopping ...")
+                break
+            if "/list/" in e.link:
+                # No need to parse a movie list
+                logger.debug("Skipping entry, contains unparseable list.")
+                continue
+            if hasattr(e, "letterboxd_memberrating"):
+                # e.letterboxd_memberrating not empty
+                rating = e.letterboxd_memberrating
+            else:
+                rating = 0  # Users cannot rate 0 on letterboxd, so we can use it
+            movie_rows.append(
+                (
+                    e.id,
+                    0,
+                    e.link,
+                    e.letterboxd_filmtitle,
+                    int(e.letterboxd_filmyear),
+                    rating,
+                    int(e.letterboxd_rewatch == "Yes"),
+                    feed_entry_date(e),
+                    user.user_id,
+                    0,
                 )
-            logger.debug(
-                "Updated movie '%s' with IMDB ID '%s', Release Date '%s' and Runtime of '%s'."
-                % (title, imdb_id, release_date, runtime)
-            )
-        except requests.RequestException as err:
-            logger.error(
-                "Requests Error - Could not fetch informations for movie '%s' with id '%s': %s"
-                % (title, tmdb_id, err)
-            )
-            continue
-        except Exception as err:
-            logger.error(
-                "Unknown Error - Could not fetch informations for movie '%s' with id '%s': %s"
-                % (title, tmdb_id, err)
             )
+        except BaseException as err:
+            logger.debug(err)
+            logger.debug("Error while trying to parse movie. Continuing ...")
             continue
-    logger.info("Finished fetching movie informations from TMDB.")
+    return movie_rows
 
 
-def fetch_movies(user_list, db):
+def download_feed(user: helper.User, host_limits):
+    """
+    Downloads and parses a single rss feed while holding a slot of the
+    feed's host, so no host sees more parallel requests than allowed.
+    The request is conditional on the validators of the last fetch.
+    :param user:
+    :param host_limits: semaphore per host
+    :return: parsed feed
     """
-    Collects movies from user's rss feed and saves them to the database
+    conditional_headers = {}
+    if user.feed_etag:
+        conditional_headers["If-None-Match"] = user.feed_etag
+    if user.feed_modified:
+        conditional_headers["If-Modified-Since"] = user.feed_modified
+    with host_limits[urlparse(user.feed_url).netloc]:
+        resp = client.letterboxd().get(user.feed_url, headers=conditional_headers)
+    if resp.status_code == 304:
+        return feedparser.FeedParserDict(status=304, entries=[])
+    resp.raise_for_status()
+    feed = feedparser.parse(resp.content)
+    feed["status"] = resp.status_code
+    feed["etag"] = resp.headers.get("ETag")
+    feed["modified"] = resp.headers.get("Last-Modified")
+    return feed
 
-    :param user_list:
-    :param db:
+
+def save_feed_state(user: helper.User, feed):
+    """
+    Remembers the validators and the newest entry of a processed feed
+    :param user:
+    :param feed:
     :return:
     """
-    for user in user_list:
-        logger.debug(f"Fetching movies for user '%s' ..." % user_list[user].username)
+    last_letterboxd_id = user.last_letterboxd_id
+    last_published = user.last_published
+    if feed.entries:
         try:
-            feed = feedparser.parse(user_list[user].feed_url)
-            for e in feed.entries:
-                try:
-                    if "/list/" in e.link:
-                        # No need to parse a movie list
-                        logger.debug("Skipping entry, contains unparseable list.")
-                        continue
-                    if hasattr(e, "letterboxd_memberrating"):
-                        # e.letterboxd_memberrating not empty
-                        movie = helper.Movie(
-                            letterboxd_id=e.id,
-                            db=db,
-                            url=e.link,
-                            title=e.letterboxd_filmtitle,
-                            year=int(e.letterboxd_filmyear),
-                            rating=e.letterboxd_memberrating,
-                            date=datetime.fromtimestamp(
-                                mktime(e.published_parsed)
-                            ).isoformat(),
-                            user=user_list[user],
-                            rewatch=int(e.letterboxd_rewatch == "Yes"),
-                        )
-                        logger.debug(f"Saved movie '%s' to database ..." % movie.title)
-                    else:
-                        movie = helper.Movie(
-                            letterboxd_id=e.id,
-                            db=db,
-                            url=e.link,
-                            title=e.letterboxd_filmtitle,
-                            year=int(e.letterboxd_filmyear),
-                            rating=0,  # Users cannot rate 0 on letterboxd, so we can use it
-                            date=datetime.fromtimestamp(
-                                mktime(e.published_parsed)
-                            ).isoformat(),
-                            user=user_list[user],
-                            rewatch=int(e.letterboxd_rewatch == "Yes"),
-                        )
-                        logger.debug(f"Saved movie '%s' to database ..." % movie.title)
-                except BaseException as err:
-                    logger.debug(err)
-                    logger.debug("Error while trying to parse movie. Continuing ...")
-                    continue
+            last_letterboxd_id, last_published = (
+                feed.entries[0].id,
+                feed_entry_date(feed.entries[0]),
+            )
         except BaseException as err:
             logger.debug(err)
-            logger.debug(
-                f"Error while catching feed for user '%s'. Skipping ..."
-                % user_list[user].username
-            )
-            continue
+            logger.debug("Could not read newest feed entry. Keeping mark ...")
+    user.save_feed_state(
+        feed.get("etag"), feed.get("modified"), last_letterboxd_id, last_published
+    )
+
+
+def fetch_user_movies(db: helper.DB, user: helper.User, host_limits):
+    """
+    Downloads the rss feed of a user and saves new movies together with the
+    feed state in one transaction
+    :param db:
+    :param user:
+    :param host_limits: semaphore per host
+    :return: tuple of the number of new movies and the letterboxd ids of all
+             parsed entries, None if the feed did not change
+    """
+    logger.debug(f"Fetching movies for user '%s' ..." % user.username)
+    feed = download_feed(user, host_limits)
+    if feed.get("status") == 304:
+        logger.debug("Feed not modified since last fetch. Skipping ...")
+        return None
+    movie_rows = parse_feed_entries(feed, user)
+    with db.transaction():
+        saved = helper.save_movies(db, movie_rows)
+        save_feed_state(user, feed)
+    logger.info("Saved %s new movies of user '%s'." % (saved, user.username))
+    return saved, [row[0] for row in movie_rows]
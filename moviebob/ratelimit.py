@@ -0,0 +1,70 @@
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. `rate` tokens are refilled per second up to
+    `capacity`, every request consumes one token.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """
+        Seconds until a token is available, without taking it
+        :return: 0 if a token is available right now
+        """
+        with self.lock:
+            now = monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def try_acquire(self):
+        """
+        Takes a token if one is available
+        :return: 0 on success, otherwise the seconds to wait before retrying
+        """
+        with self.lock:
+            now = monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        :return:
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hands out no tokens for the given time, e.g. after a `Retry-After`
+        :param seconds:
+        :return:
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
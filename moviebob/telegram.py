@@ -1,168 +1,338 @@
-from time import sleep
+import threading
 from logzero import logger
 from datetime import datetime
 from dateutil import relativedelta
-import telegram
-
-
-def send_movie_updates(db, bot, chat_id, user_list):
+from moviebob import helper
+from moviebob import metrics
+
+
+# Telegram's maximum message length
+MAX_MESSAGE_LENGTH = 4096
+
+# Outbox delivery across runs
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_BACKOFF = 60
+OUTBOX_RETENTION_DAYS = 90
+
+# Only one drain per process at a time, other processes are kept apart by
+# the claims on the outbox rows
+drain_lock = threading.Lock()
+
+# Queries of the yearly recap
+UNIQUE_COUNT_QUERY = """
+    SELECT COUNT(DISTINCT tmdb_id)
+    FROM movies
+    WHERE date >= ? AND date < ?
+"""
+# Highest rated movie watched in a date range
+BEST_MOVIE_QUERY = """
+    SELECT movies.tmdb_id, movies.title, letterboxd_avg
+    FROM movies
+    INNER JOIN users ON users.user_id = movies.user
+    INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
+    WHERE letterboxd_avg != 0.0 AND date >= ? AND date < ?
+    ORDER BY letterboxd_avg DESC
+    LIMIT 1
+"""
+WORST_MOVIE_QUERY = BEST_MOVIE_QUERY.replace("DESC", "ASC")
+# Everyone who watched a movie
+MOVIE_USERS_QUERY = """
+    SELECT movies.title, nickname, letterboxd_avg
+    FROM movies
+    INNER JOIN users ON users.user_id = movies.user
+    INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
+    WHERE movies.tmdb_id = ?
+"""
+
+
+def queue_movie_updates(db, chat_id, user_list, digest_threshold=0, movie_ids=None):
     """
-    Sends updates about new movies to specific telegram group
+    Renders updates about new movies for specific telegram group into the
+    outbox. With more than `digest_threshold` pending movies they are packed
+    into digests. Movies are flagged notified as soon as their message is
+    queued, in the same transaction, delivery is left to `drain_outbox`.
     :param db:
-    :param bot:
     :param chat_id:
     :param user_list:
+    :param digest_threshold: 0 disables digests
+    :param movie_ids: optionally only these movies
     :return:
     """
-    with db.ops() as c:
-        c.execute(
-            """
-            SELECT title, url, user, movie_id, tmdb_id, rewatch FROM movies WHERE notified = 0;
-        """
+    notifications = helper.fetch_pending_notifications(
+        db, [user_list[user].user_id for user in user_list], movie_ids
+    )
+    if digest_threshold and len(notifications) > digest_threshold:
+        logger.info(
+            "%s pending movies, queueing them as digest ..." % len(notifications)
         )
-        r = c.fetchall()
-        for movie in r:
-            for user in user_list:
-                if user_list[user].user_id == movie[2]:
-                    msg_text = ""
-                    c.execute(
-                        """SELECT
-                                tmdb_id,
-                                title,
-                                runtime,
-                                release_date,
-                                letterboxd_avg,
-                                shortfilm
-                            FROM tmdb
-                            WHERE tmdb_id = ?""",
-                        (movie[4],),
-                    )
-                    meta = c.fetchone()
-                    runtime = meta[2]
-                    letterboxd_avg = meta[4]
-                    if letterboxd_avg == float("0.0"):
-                        letterboxd_avg = ""
-                    icon = "🍿"
-                    shortfilm = meta[5]
-                    if shortfilm and movie[5]:
-                        icon = "🍿🩳🔄"
-                    elif shortfilm:
-                        icon = "🍿🩳"
-                    elif movie[5]:
-                        icon = "🍿🔄"
-                    if shortfilm and runtime and letterboxd_avg:
-                        msg_text = (
-                            f"%s %s hat sich '%s' mit %s Minuten Länge (Shortfilm: 0,5 Pkt.) und einer durschnittlichen Letterboxd Wertung von %s/5 reingezogen: %s"
-                            % (
-                                icon,
-                                user_list[user].nickname,
-                                movie[0],
-                                runtime,
-                                letterboxd_avg,
-                                movie[1],
-                            )
-                        )
-                    elif runtime and letterboxd_avg:
-                        msg_text = (
-                            f"%s %s hat sich '%s' mit %s Minuten Länge und einer durschnittlichen Letterboxd Wertung von %s/5 reingezogen: %s"
-                            % (
-                                icon,
-                                user_list[user].nickname,
-                                movie[0],
-                                runtime,
-                                letterboxd_avg,
-                                movie[1],
-                            )
-                        )
-                    elif shortfilm and runtime:
-                        msg_text = (
-                            f"%s %s hat sich '%s' mit %s Minuten Länge (Shortfilm: 0,5 Pkt.) reingezogen: %s"
-                            % (
-                                icon,
-                                user_list[user].nickname,
-                                movie[0],
-                                runtime,
-                                movie[1],
-                            )
-                        )
-                    elif runtime:
-                        msg_text = (
-                            f"%s %s hat sich '%s' mit %s Minuten Länge reingezogen: %s"
-                            % (
-                                icon,
-                                user_list[user].nickname,
-                                movie[0],
-                                runtime,
-                                movie[1],
-                            )
-                        )
-                    elif letterboxd_avg:
-                        msg_text = (
-                            f"%s %s hat sich '%s' mit einer durschnittlichen Letterboxd Wertung von %s/5 reingezogen: %s"
-                            % (
-                                icon,
-                                user_list[user].nickname,
-                                movie[0],
-                                letterboxd_avg,
-                                movie[1],
-                            )
-                        )
-                    else:
-                        msg_text = f"%s %s hat sich '%s': %s" % (
-                            icon,
-                            user_list[user].nickname,
-                            movie[0],
-                            movie[1],
-                        )
-                    send_movie_msg(bot, chat_id, msg_text, movie[3], db)
+        msgs = [
+            (
+                "digest",
+                "digest:%s-%s" % (digest_ids[0], digest_ids[-1]),
+                msg,
+                digest_ids,
+            )
+            for msg, digest_ids in create_digest_msgs(notifications)
+        ]
+    else:
+        msgs = [
+            (
+                "movie",
+                "movie:%s" % notification.movie_id,
+                create_movie_msg(notification),
+                [notification.movie_id],
+            )
+            for notification in notifications
+        ]
+    # Once a movie is in the outbox the outbox takes care of its delivery
+    with db.ops() as c:
+        for kind, dedupe_key, msg, msg_movie_ids in msgs:
+            helper.queue_message(c, chat_id, kind, dedupe_key, msg, msg_movie_ids)
+            c.executemany(
+                """
+                UPDATE movies
+                SET notified = 1
+                WHERE movie_id = ?
+            """,
+                [(movie_id,) for movie_id in msg_movie_ids],
+            )
     logger.info("Every movie in database got parsed :)")
 
 
-def send_movie_msg(bot, chat_id, msg, movie_id, db, attempt=0):
-    if attempt > 2:
-        logger.info(f"Maximum attempts reached. Skipping '%s' ..." % msg)
-        return
-    attempt = attempt + 1
-    try:
-        logger.info(f"Attempt %s: Sending Notification: %s" % (attempt, msg))
-        bot.sendMessage(
-            chat_id=chat_id,
-            text=msg,
+def message_length(msg):
+    # Telegram counts UTF-16 code units, most emojis take two of them
+    return len(msg.encode("utf-16-le")) // 2
+
+
+def create_digest_msgs(notifications):
+    """
+    Packs the rendered notifications into as few messages as the length
+    limit allows
+    :param notifications:
+    :return: list of (message, movie_ids)
+    """
+    digests = []
+    msg = ""
+    movie_ids = []
+    for notification in notifications:
+        movie_msg = create_movie_msg(notification)
+        if movie_ids and (
+            message_length(msg) + 2 + message_length(movie_msg) > MAX_MESSAGE_LENGTH
+        ):
+            digests.append((msg, movie_ids))
+            msg = ""
+            movie_ids = []
+        msg = movie_msg if not movie_ids else msg + "\n\n" + movie_msg
+        movie_ids.append(notification.movie_id)
+    if movie_ids:
+        digests.append((msg, movie_ids))
+    return digests
+
+
+def create_movie_msg(movie: helper.Notification):
+    msg_text = ""
+    runtime = movie.runtime
+    letterboxd_avg = movie.letterboxd_avg
+    if letterboxd_avg == float("0.0"):
+        letterboxd_avg = ""
+    icon = "🍿"
+    shortfilm = movie.shortfilm
+    if shortfilm and movie.rewatch:
+        icon = "🍿🩳🔄"
+    elif shortfilm:
+        icon = "🍿🩳"
+    elif movie.rewatch:
+        icon = "🍿🔄"
+    if shortfilm and runtime and letterboxd_avg:
+        msg_text = (
+            f"%s %s hat sich '%s' mit %s Minuten Länge (Shortfilm: 0,5 Pkt.) und einer durschnittlichen Letterboxd Wertung von %s/5 reingezogen: %s"
+            % (
+                icon,
+                movie.nickname,
+                movie.title,
+                runtime,
+                letterboxd_avg,
+                movie.url,
+            )
         )
-        sleep(0.3)  # Helps with timeouts
-    except telegram.error.TimedOut:
-        logger.debug(f"Sending '%s' timed out!" % msg)
-        sleep(3)
-        send_movie_msg(bot, chat_id, msg, movie_id, db, attempt)
-    except telegram.error.RetryAfter as err:
-        logger.info(
-            f"Sending '%s' was blocked. Retrying in %s seconds ..."
-            % (msg, err.retry_after)
+    elif runtime and letterboxd_avg:
+        msg_text = (
+            f"%s %s hat sich '%s' mit %s Minuten Länge und einer durschnittlichen Letterboxd Wertung von %s/5 reingezogen: %s"
+            % (
+                icon,
+                movie.nickname,
+                movie.title,
+                runtime,
+                letterboxd_avg,
+                movie.url,
+            )
+        )
+    elif shortfilm and runtime:
+        msg_text = (
+            f"%s %s hat sich '%s' mit %s Minuten Länge (Shortfilm: 0,5 Pkt.) reingezogen: %s"
+            % (
+                icon,
+                movie.nickname,
+                movie.title,
+                runtime,
+                movie.url,
+            )
+        )
+    elif runtime:
+        msg_text = (
+            f"%s %s hat sich '%s' mit %s Minuten Länge reingezogen: %s"
+            % (
+                icon,
+                movie.nickname,
+                movie.title,
+                runtime,
+                movie.url,
+            )
+        )
+    elif letterboxd_avg:
+        msg_text = (
+            f"%s %s hat sich '%s' mit einer durschnittlichen Letterboxd Wertung von %s/5 reingezogen: %s"
+            % (
+                icon,
+                movie.nickname,
+                movie.title,
+                letterboxd_avg,
+                movie.url,
+            )
         )
-        sleep(err.retry_after)
-        send_movie_msg(bot, chat_id, msg, movie_id, db, attempt)
-    except BaseException as e:
-        logger.debug(f"Unknown error while sending telegram message: %s" % e)
-        sleep(3)
-        send_movie_msg(bot, chat_id, msg, movie_id, db, attempt)
     else:
-        # If no exception was thrown
-        with db.ops() as c:
+        msg_text = f"%s %s hat sich '%s': %s" % (
+            icon,
+            movie.nickname,
+            movie.title,
+            movie.url,
+        )
+    return msg_text
+
+
+def drain_outbox(db, dispatcher, max_attempts=OUTBOX_MAX_ATTEMPTS, blocking=True):
+    """
+    Sends every due outbox message through the dispatcher. A message is
+    flagged `sending` only while a request for it is out and `sent` once
+    telegram accepted it, failed deliveries are retried by later runs with
+    backoff. Messages are claimed for this run first, so runs of several
+    processes on the same database never send a message twice.
+    :param db:
+    :param dispatcher:
+    :param max_attempts: runs that may fail before a message is given up
+    :param blocking: wait for a drain of another thread instead of skipping
+    :return: False if the drain was skipped
+    """
+    if not drain_lock.acquire(blocking):
+        logger.debug("Outbox is being drained already. Skipping ...")
+        return False
+    try:
+        _drain_outbox(db, dispatcher, max_attempts)
+    finally:
+        drain_lock.release()
+    return True
+
+
+def _drain_outbox(db, dispatcher, max_attempts):
+    msgs = helper.fetch_due_messages(db)
+    if not msgs:
+        logger.debug("Outbox is empty.")
+        return
+    logger.info("Sending %s messages from outbox ..." % len(msgs))
+    for msg in msgs:
+        dispatcher.submit(
+            msg.chat_id,
+            msg.text,
+            on_success=lambda msg=msg: set_outbox_status(db, msg, "sent"),
+            on_failure=lambda err, msg=msg: set_outbox_status(
+                db,
+                msg,
+                "failed" if msg.attempts + 1 >= max_attempts else "pending",
+                err,
+            ),
+            on_send=lambda msg=msg: set_outbox_status(db, msg, "sending"),
+            # Not delivered, a crash before the next attempt must not count
+            # the message as sent
+            on_retry=lambda msg=msg: set_outbox_status(db, msg, "queued"),
+        )
+    dispatcher.run()
+    with db.ops() as c:
+        c.execute(
+            """
+            DELETE FROM outbox
+            WHERE status = 'sent' AND sent_at < datetime('now', ?)
+        """,
+            ("-%d day" % OUTBOX_RETENTION_DAYS,),
+        )
+
+
+def set_outbox_status(db, msg, status, error=None):
+    """
+    Records the progress of an outbox message. Rows are only changed while
+    `msg` still holds the claim on them, a run whose lease expired can not
+    overwrite the progress of the run that took over.
+    :param db:
+    :param msg:
+    :param status: `sending` before a request, `queued` after an attempt
+                   the dispatcher retries, `sent`, or `pending` / `failed`
+                   for a run that gave up on the message
+    :param error:
+    :return:
+    """
+    if status not in ("sending", "queued"):
+        metrics.inc("moviebob_outbox_messages_total", kind=msg.kind, status=status)
+    with db.ops() as c:
+        if status in ("sending", "queued"):
+            # Every attempt renews the lease
             c.execute(
                 """
-                UPDATE movies
-                SET notified = 1
-                WHERE movie_id = ?
+                UPDATE outbox
+                SET status = ?, claimed_at = datetime('now')
+                WHERE id = ? AND claimed_by = ?
+            """,
+                (
+                    "sending" if status == "sending" else "pending",
+                    msg.id,
+                    msg.claimed_by,
+                ),
+            )
+            if c.rowcount != 1 and status == "sending":
+                raise RuntimeError(
+                    "Outbox message %s was claimed by another run" % msg.id
+                )
+        elif status == "sent":
+            c.execute(
+                """
+                UPDATE outbox
+                SET status = 'sent', sent_at = datetime('now'), last_error = NULL,
+                    claimed_by = NULL
+                WHERE id = ? AND claimed_by = ?
             """,
-                (movie_id,),
+                (msg.id, msg.claimed_by),
+            )
+        else:
+            if status == "failed":
+                logger.error(f"Giving up on outbox message %s: %s" % (msg.id, error))
+            # Exponential backoff between runs, at least as long as telegram
+            # asked to wait
+            backoff = max(
+                OUTBOX_BACKOFF * 2**msg.attempts, getattr(error, "retry_after", 0)
+            )
+            c.execute(
+                """
+                UPDATE outbox
+                SET status = ?, attempts = attempts + 1, last_error = ?,
+                    next_attempt_at = datetime('now', ?), claimed_by = NULL
+                WHERE id = ? AND claimed_by = ?
+            """,
+                (status, str(error), "+%d seconds" % backoff, msg.id, msg.claimed_by),
             )
-            return
 
 
-def fetch_monthly_update(db, bot, chat_id):
+def fetch_monthly_update(db, chat_id):
     """
-    Checks if the monthly update got sent out and prepares the message if not
-    :param bot:
+    Checks if the monthly update got queued and prepares the message if not
+    :param chat_id:
     :param db:
     :param user_list:
     :return:
@@ -178,141 +348,87 @@ def fetch_monthly_update(db, bot, chat_id):
             (current_month, current_year),
         )
         r = c.fetchone()
-        if r is None:
-            logger.info("Monthly update not sent, preparing message ...")
-            send_monthly_msg(
-                bot,
+    if r is None:
+        logger.info("Monthly update not sent, preparing message ...")
+        msg = create_monthly_msg(db)
+        with db.ops() as c:
+            helper.queue_message(
+                c,
                 chat_id,
-                create_monthly_msg(db),
-                current_month,
-                current_year,
-                db,
+                "monthly",
+                "monthly:%s-%02d" % (current_year, current_month),
+                msg,
+            )
+            c.execute(
+                """
+                INSERT into monthly(month, year, notified)
+                VALUES (?, ?, ?)
+            """,
+                (current_month, current_year, 1),
             )
 
 
 def create_monthly_msg(db):
-    watch_list = []
-    rewatch_list = []
-    shortfilm_list = []
     msg_list = []
-    user_list = []
-    target_month = (datetime.now() + relativedelta.relativedelta(months=-1)).month
-    target_year = (datetime.now() + relativedelta.relativedelta(months=-1)).year
-    target_start = f"datetime('%d-%02d-01 00:00:00')" % (target_year, target_month)
-    target_end = f"datetime('%d-%02d-31 23:59:59')" % (target_year, target_month)
+    target = datetime.now() + relativedelta.relativedelta(months=-1)
+    target_month = target.month
+    target_year = target.year
+    target_start = "%d-%02d-01" % (target_year, target_month)
+    target_end = (
+        datetime(target_year, target_month, 1) + relativedelta.relativedelta(months=1)
+    ).strftime("%Y-%m-%d")
 
-    with db.ops() as c:
-        c.execute(
-            """
-            SELECT user, nickname, COUNT(movie_id)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            WHERE date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY COUNT(movie_id) DESC
-            """
-            % (target_start, target_end)
-        )
-        watch_list = c.fetchall()
-        c.execute(
-            """
-            SELECT user, nickname, COUNT(movie_id)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            WHERE rewatch = 1 AND date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY COUNT(movie_id) DESC
-            """
-            % (target_start, target_end)
-        )
-        rewatch_list = c.fetchall()
-        c.execute(
-            """
-            SELECT user, nickname, COUNT(movie_id)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-            WHERE shortfilm = 1 AND date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY COUNT(movie_id) DESC
-            """
-            % (target_start, target_end)
-        )
-        shortfilm_list = c.fetchall()
-
-    for user in watch_list:
-        user_id = user[0]
-        nickname = user[1]
-        watch_count = user[2]
-        rewatch_count = 0
-        for rewatch in rewatch_list:
-            if rewatch[0] == user_id:
-                rewatch_count = rewatch[2]
-        shortfilm_count = 0
-        for shortfilm in shortfilm_list:
-            if shortfilm[0] == user_id:
-                shortfilm_count = shortfilm[2]
-
-        # Probably should be reworked into the User Class
-        user_list.append(
-            {
-                "user_id": user_id,
-                "nickname": nickname,
-                "watch_count": watch_count,
-                "rewatch_count": rewatch_count,
-                "shortfilm_count": shortfilm_count,
-            }
-        )
+    user_list = helper.fetch_user_stats(db, target_start, target_end)
 
     for i, user in enumerate(user_list):
         if i == 0:
             msg_list.append(
                 "- 🥇 Wuhu! Gute Arbeit! %s hat sich massive %s Filme reingedübelt, davon %s Rewatches und %s Shortfilms"
                 % (
-                    user["nickname"],
-                    user["watch_count"],
-                    user["rewatch_count"],
-                    user["shortfilm_count"],
+                    user.nickname,
+                    user.watch_count,
+                    user.rewatch_count,
+                    user.shortfilm_count,
                 )
             )
         elif i == 1:
             msg_list.append(
                 "- 🥈 Zweiter Platz für %s! Hat sich ordentlich %s Filme einverleibt, davon %s Rewatches und %s Shortfilms"
                 % (
-                    user["nickname"],
-                    user["watch_count"],
-                    user["rewatch_count"],
-                    user["shortfilm_count"],
+                    user.nickname,
+                    user.watch_count,
+                    user.rewatch_count,
+                    user.shortfilm_count,
                 )
             )
         elif i == 2:
             msg_list.append(
                 "- 🥉 Letztes Edelmetal geht an %s mit %s Filmen unterm Gürtel, davon %s Rewatches und %s Shortfilms"
                 % (
-                    user["nickname"],
-                    user["watch_count"],
-                    user["rewatch_count"],
-                    user["shortfilm_count"],
+                    user.nickname,
+                    user.watch_count,
+                    user.rewatch_count,
+                    user.shortfilm_count,
                 )
             )
         elif i == 3:
             msg_list.append(
                 "- 🍄 Knapp am Podium vorbei! %s hat sich trotzdem %s Filme reingedübelt, davon %s Rewatches und %s Shortfilms"
                 % (
-                    user["nickname"],
-                    user["watch_count"],
-                    user["rewatch_count"],
-                    user["shortfilm_count"],
+                    user.nickname,
+                    user.watch_count,
+                    user.rewatch_count,
+                    user.shortfilm_count,
                 )
             )
         elif i == 4:
             msg_list.append(
                 "- 🥑 Schon wenig, aber immernoch besser als Letzer! %s hat sich %s Filme gegönnt, davon %s Rewatches und %s Shortfilms"
                 % (
-                    user["nickname"],
-                    user["watch_count"],
-                    user["rewatch_count"],
-                    user["shortfilm_count"],
+                    user.nickname,
+                    user.watch_count,
+                    user.rewatch_count,
+                    user.shortfilm_count,
                 )
             )
         else:
@@ -320,10 +436,10 @@ def create_monthly_msg(db):
                 "- 🍑 %s hatte wohl Bessers zu tun, und schaffte es nur auf %s Film(e), "
                 "davon %s Rewatche(s) und %s Shortfilms"
                 % (
-                    user["nickname"],
-                    user["watch_count"],
-                    user["rewatch_count"],
-                    user["shortfilm_count"],
+                    user.nickname,
+                    user.watch_count,
+                    user.rewatch_count,
+                    user.shortfilm_count,
                 )
             )
 
@@ -338,47 +454,7 @@ def create_monthly_msg(db):
     return msg
 
 
-def send_monthly_msg(bot, chat_id, msg, current_month, current_year, db, attempt=0):
-    if attempt > 2:
-        logger.debug(f"Maximum attempts reached. Skipping '%s' ..." % msg)
-        return
-    attempt = attempt + 1
-    try:
-        logger.info(f"Attempt %s: Sending Notification: %s" % (attempt, msg))
-        bot.sendMessage(
-            chat_id=chat_id,
-            text=msg,
-        )
-        sleep(0.3)  # Helps with timeouts
-    except telegram.error.TimedOut:
-        logger.debug(f"Sending '%s' timed out!" % msg)
-        sleep(3)
-        send_monthly_msg(bot, chat_id, msg, current_month, current_year, db, attempt)
-    except telegram.error.RetryAfter as err:
-        logger.info(
-            f"Sending '%s' was blocked. Retrying in %s seconds ..."
-            % (msg, err.retry_after)
-        )
-        sleep(err.retry_after)
-        send_monthly_msg(bot, chat_id, msg, current_month, current_year, db, attempt)
-    except BaseException as e:
-        logger.debug(f"Unknown error while sending telegram message: %s" % e)
-        sleep(3)
-        send_monthly_msg(bot, chat_id, msg, current_month, current_year, db, attempt)
-    else:
-        # If no exception was thrown
-        with db.ops() as c:
-            c.execute(
-                """
-                INSERT into monthly(month, year, notified)
-                VALUES (?, ?, ?)
-            """,
-                (current_month, current_year, 1),
-            )
-            return
-
-
-def fetch_yearly_update(db, bot, chat_id):
+def fetch_yearly_update(db, chat_id):
     # current_day = datetime.now().day
     # current_month = datetime.now().month
     current_year = datetime.now().year - 1
@@ -391,135 +467,41 @@ def fetch_yearly_update(db, bot, chat_id):
             (current_year,),
         )
         r = c.fetchone()
-        if r is None:
-            logger.info("Yearly update not sent, preparing message ...")
-            send_yearly_msg(
-                bot,
-                chat_id,
-                create_yearly_msg(current_year, db),
-                current_year,
-                db,
+    if r is None:
+        logger.info("Yearly update not sent, preparing message ...")
+        msg = create_yearly_msg(current_year, db)
+        with db.ops() as c:
+            helper.queue_message(
+                c, chat_id, "yearly", "yearly:%s" % current_year, msg
+            )
+            c.execute(
+                """
+                INSERT into yearly(year, notified)
+                VALUES (?, ?)
+            """,
+                (current_year, 1),
             )
 
 
 def create_yearly_msg(year, db):
-    watch_list = []
-    rewatch_list = []
-    shortfilm_list = []
-    runtime_list = []
-    avg_list = []
-    user_list = []
-    target_start = f"datetime('%d-01-01 00:00:00')" % year
-    target_end = f"datetime('%d-12-31 23:59:59')" % year
-
+    target_start = "%d-01-01" % year
+    target_end = "%d-01-01" % (year + 1)
+
+    user_list = helper.fetch_user_stats(db, target_start, target_end)
+    runtime_list = sorted(
+        [user for user in user_list if user.tmdb_count],
+        key=lambda user: user.runtime_sum,
+        reverse=True,
+    )
+    avg_list = sorted(
+        [user for user in user_list if user.letterboxd_avg is not None],
+        key=lambda user: user.letterboxd_avg,
+        reverse=True,
+    )
     with db.ops() as c:
-        c.execute(
-            """
-            SELECT user, nickname, COUNT(movie_id)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            WHERE date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY COUNT(movie_id) DESC
-            """
-            % (target_start, target_end)
-        )
-        watch_list = c.fetchall()
-        c.execute(
-            """
-            SELECT user, nickname, COUNT(movie_id)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            WHERE rewatch = 1 AND date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY COUNT(movie_id) DESC
-            """
-            % (target_start, target_end)
-        )
-        rewatch_list = c.fetchall()
-        c.execute(
-            """
-            SELECT user, nickname, COUNT(movie_id)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-            WHERE shortfilm = 1 AND date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY COUNT(movie_id) DESC
-            """
-            % (target_start, target_end)
-        )
-        shortfilm_list = c.fetchall()
-        c.execute(
-            """
-            SELECT user, nickname, SUM(runtime)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-            WHERE date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY SUM(runtime) DESC
-            """
-            % (target_start, target_end)
-        )
-        runtime_list = c.fetchall()
-        c.execute(
-            """
-            SELECT user, nickname, AVG(letterboxd_avg)
-            FROM movies
-            INNER JOIN users ON users.user_id = movies.user
-            INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-            WHERE date BETWEEN %s AND %s
-            GROUP BY user
-            ORDER BY AVG(letterboxd_avg) DESC
-            """
-            % (target_start, target_end)
-        )
-        avg_list = c.fetchall()
-        c.execute(
-            """
-            SELECT COUNT(DISTINCT tmdb_id)
-            FROM movies
-            WHERE date BETWEEN %s AND %s;
-            """
-            % (target_start, target_end)
-        )
+        c.execute(UNIQUE_COUNT_QUERY, (target_start, target_end))
         unique_count = c.fetchone()[0]
 
-    for user in watch_list:
-        user_id = user[0]
-        nickname = user[1]
-        watch_count = user[2]
-        rewatch_count = 0
-        for rewatch in rewatch_list:
-            if rewatch[0] == user_id:
-                rewatch_count = rewatch[2]
-        shortfilm_count = 0
-        for shortfilm in shortfilm_list:
-            if shortfilm[0] == user_id:
-                shortfilm_count = shortfilm[2]
-        runtime_sum = 0
-        for runtime in runtime_list:
-            if runtime[0] == user_id:
-                runtime_sum = runtime[2]
-        letterboxd_avg = 0
-        for a in avg_list:
-            if a[0] == user_id:
-                letterboxd_avg = round(a[2], 2)
-
-        # Probably should be reworked into the User Class
-        user_list.append(
-            {
-                "user_id": user_id,
-                "nickname": nickname,
-                "watch_count": watch_count,
-                "rewatch_count": rewatch_count,
-                "shortfilm_count": shortfilm_count,
-                "runtime_sum": runtime_sum,
-                "letterboxd_avg": letterboxd_avg,
-            }
-        )
-
     msg_header = (
         "🍾 %s Sylvester Recap 🍾\n\nScheiß auf Recaps von Spotify, Letterboxd, Steam, ... eh alles gezinkt! Nur hier gibt's klare, harte und auch echte Fakten!! Der jährliche Moviebob Rückblick für's Jahr %s:\n\n"
         % (year, year)
@@ -534,47 +516,6 @@ def create_yearly_msg(year, db):
     return msg
 
 
-def send_yearly_msg(bot, chat_id, msg, current_year, db, attempt=0):
-    if attempt > 2:
-        logger.debug(f"Maximum attempts reached. Skipping '%s' ..." % msg)
-        return
-    attempt = attempt + 1
-    try:
-        logger.info(f"Attempt %s: Sending Notification: %s" % (attempt, msg))
-        bot.sendMessage(
-            chat_id=chat_id,
-            text=msg,
-        )
-        sleep(0.3)  # Helps with timeouts
-    except telegram.error.TimedOut:
-        logger.debug(f"Sending '%s' timed out!" % msg)
-        sleep(3)
-        send_yearly_msg(bot, chat_id, msg, current_year, db, attempt)
-    except telegram.error.RetryAfter as err:
-        logger.info(
-            f"Sending '%s' was blocked. Retrying in %s seconds ..."
-            % (msg, err.retry_after)
-        )
-        sleep(err.retry_after)
-        send_yearly_msg(bot, chat_id, msg, current_year, db, attempt)
-    except BaseException as e:
-        logger.debug(f"Unknown error while sending telegram message: %s" % e)
-        sleep(3)
-        send_yearly_msg(bot, chat_id, msg, current_year, db, attempt)
-    else:
-        print("Yearly Message success!!")
-        # If no exception was thrown
-        with db.ops() as c:
-            c.execute(
-                """
-                INSERT into yearly(year, notified)
-                VALUES (?, ?)
-            """,
-                (current_year, 1),
-            )
-            return
-
-
 def create_yearly_runtime_msg(runtime_list):
     msg_list = []
     runtime_sum = 0
@@ -583,9 +524,14 @@ def create_yearly_runtime_msg(runtime_list):
     for i, user in enumerate(runtime_list):
         msg_list.append(
             "%s. %s mit %s Minuten (~ %s Tage)"
-            % (i + 1, user[1], user[2], round(user[2] / 60 / 24, 2))
+            % (
+                i + 1,
+                user.nickname,
+                user.runtime_sum,
+                round(user.runtime_sum / 60 / 24, 2),
+            )
         )
-        runtime_sum = runtime_sum + user[2]
+        runtime_sum = runtime_sum + user.runtime_sum
 
     msg_footer = (
         "\n\nZusammen hat die Gruppe übrigens %s Minuten (~ %s Tage) Filme geschaut!"
@@ -601,59 +547,18 @@ def create_yearly_letterboxd_avg_msg(letterboxd_avg_list, db, target_start, targ
 
     for i, user in enumerate(letterboxd_avg_list):
         msg_list.append(
-            "%s. %s mit einem Average von %s / 5" % (i + 1, user[1], round(user[2], 2))
+            "%s. %s mit einem Average von %s / 5"
+            % (i + 1, user.nickname, round(user.letterboxd_avg, 2))
         )
 
-    print(target_start)
-    print(target_end)
     with db.ops() as c:
-        c.execute(
-            """
-                SELECT movies.tmdb_id, movies.title, letterboxd_avg
-                FROM movies
-                INNER JOIN users ON users.user_id = movies.user
-                INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-                WHERE letterboxd_avg != 0.0 AND date BETWEEN %s AND %s
-                ORDER BY letterboxd_avg DESC
-                LIMIT 1;
-            """
-            % (target_start, target_end)
-        )
+        c.execute(BEST_MOVIE_QUERY, (target_start, target_end))
         best_movie = c.fetchone()
-        c.execute(
-            """
-                SELECT movies.title, nickname, letterboxd_avg
-                FROM movies
-                INNER JOIN users ON users.user_id = movies.user
-                INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-                WHERE movies.tmdb_id = ?
-            """,
-            (best_movie[0],),
-        )
+        c.execute(MOVIE_USERS_QUERY, (best_movie[0],))
         best_movie_users = c.fetchall()
-        c.execute(
-            """
-                SELECT movies.tmdb_id, movies.title, letterboxd_avg
-                FROM movies
-                INNER JOIN users ON users.user_id = movies.user
-                INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-                WHERE letterboxd_avg != 0.0 AND date BETWEEN %s AND %s
-                ORDER BY letterboxd_avg ASC
-                LIMIT 1;
-            """
-            % (target_start, target_end)
-        )
+        c.execute(WORST_MOVIE_QUERY, (target_start, target_end))
         worst_movie = c.fetchone()
-        c.execute(
-            """
-                SELECT movies.title, nickname, letterboxd_avg
-                FROM movies
-                INNER JOIN users ON users.user_id = movies.user
-                INNER JOIN tmdb ON tmdb.tmdb_id = movies.tmdb_id
-                WHERE movies.tmdb_id = ?
-            """,
-            (worst_movie[0],),
-        )
+        c.execute(MOVIE_USERS_QUERY, (worst_movie[0],))
         worst_movie_users = c.fetchall()
 
     best_movie_users_str = ""
@@ -700,13 +605,13 @@ def create_yearly_stats_msg(user_list, unique_count):
             "%s. %s mit %s Filmen (davon %s Rewatches und %s Shortfilms)"
             % (
                 i + 1,
-                user["nickname"],
-                user["watch_count"],
-                user["rewatch_count"],
-                user["shortfilm_count"],
+                user.nickname,
+                user.watch_count,
+                user.rewatch_count,
+                user.shortfilm_count,
             )
         )
-        watch_sum = watch_sum + user["watch_count"]
+        watch_sum = watch_sum + user.watch_count
 
     msg_footer = (
         "\n\nInsgesamt hat die Gruppe dieses Jahr %s Einträge geloggt und somit %s unterschiedliche Filme geschaut!\n\nSo. Und jetzt Finger weg vom Handy und genießt weiter den BESTEN Feiertag des Jahres!! Happy New Year! 🥳"
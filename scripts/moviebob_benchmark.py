@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of a full moviebob run against local stand-ins for
+letterboxd.com, the TMDB api and the Telegram Bot API. Nothing leaves the
+machine, every service can be slowed down and TMDB / Telegram can answer
+with rate limits.
+
+    python scripts/moviebob_benchmark.py --scale 10x20 --scale 50x50 --latency 20
+
+Every scale runs twice on a fresh database: a cold run ingesting every feed
+and an incremental run in which every feed answers `304 Not Modified`.
+"""
+
+import os
+import sys
+import json
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import importlib.util
+from time import monotonic, sleep
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logzero import logger, loglevel
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from moviebob import client
+from moviebob import dispatch
+from moviebob import helper
+from moviebob import metrics
+
+# Film pages on letterboxd.com are mostly markup after the tmdb id
+FILM_PAGE_PADDING = '<div class="poster-list">%s</div>' % ("<li>film</li>" * 4000)
+
+
+def load_moviebob():
+    spec = importlib.util.spec_from_file_location(
+        "moviebob_cli", os.path.join(ROOT, "moviebob.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Services:
+    """
+    Shared state of the fake services: generated feeds, knobs and request
+    counters per endpoint
+    """
+
+    def __init__(self, users, entries, films, latency, tmdb_429, telegram_429, seed):
+        self.latency = latency
+        self.tmdb_429 = tmdb_429
+        self.telegram_429 = telegram_429
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.telegram_messages = 0
+        # Popular films are watched far more often, ranks follow a zipf curve
+        weights = [1 / rank for rank in range(1, films + 1)]
+        now = datetime.now(timezone.utc)
+        # Every feed covers the last 90 days, so the monthly recap has data
+        spacing = timedelta(days=90) / max(1, entries)
+        self.feeds = {}
+        for user in range(users):
+            username = "user%04d" % user
+            picks = self.random.choices(range(films), weights=weights, k=entries)
+            self.feeds[username] = [
+                (
+                    "letterboxd-watch-%s-%s" % (username, i),
+                    "film-%05d" % film,
+                    now - spacing * i - timedelta(minutes=user),
+                    self.random.random() < 0.1,
+                )
+                for i, film in enumerate(picks)
+            ]
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def rate_limited(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    services = None
+    base_url = ""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, status, data, headers=None):
+        self.reply(status, json.dumps(data).encode(), "application/json", headers)
+
+
+class LetterboxdHandler(Handler):
+    def do_GET(self):
+        sleep(self.services.latency)
+        path = urlparse(self.path).path.strip("/").split("/")
+        if len(path) == 2 and path[1] == "rss":
+            self.services.count("letterboxd_feed")
+            self.feed(path[0])
+        elif len(path) == 2 and path[0] == "film":
+            self.services.count("letterboxd_film")
+            self.film(path[1])
+        else:
+            self.reply(404, b"", "text/plain")
+
+    def feed(self, username):
+        entries = self.services.feeds.get(username)
+        if entries is None:
+            self.reply(404, b"", "text/plain")
+            return
+        etag = '"%s"' % hashlib.sha1(entries[0][0].encode()).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.reply(304, b"", "application/rss+xml", {"ETag": etag})
+            return
+        items = []
+        for letterboxd_id, slug, watched, rewatch in entries:
+            items.append(
+                "<item><title>%s</title><link>%s/%s/film/%s/</link>"
+                '<guid isPermaLink="false">%s</guid><pubDate>%s</pubDate>'
+                "<letterboxd:watchedDate>%s</letterboxd:watchedDate>"
+                "<letterboxd:rewatch>%s</letterboxd:rewatch>"
+                "<letterboxd:filmTitle>%s</letterboxd:filmTitle>"
+                "<letterboxd:filmYear>%s</letterboxd:filmYear>"
+                "<letterboxd:memberRating>3.5</letterboxd:memberRating></item>"
+                % (
+                    slug,
+                    self.base_url,
+                    username,
+                    slug,
+                    letterboxd_id,
+                    format_datetime(watched),
+                    watched.date().isoformat(),
+                    "Yes" if rewatch else "No",
+                    slug.replace("-", " ").title(),
+                    1950 + int(slug[-5:]) % 75,
+                )
+            )
+        body = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<rss version="2.0" xmlns:letterboxd="https://letterboxd.com">'
+            "<channel><title>%s</title>%s</channel></rss>" % (username, "".join(items))
+        )
+        self.reply(200, body.encode(), "application/rss+xml", {"ETag": etag})
+
+    def film(self, slug):
+        tmdb_id = int(slug[-5:]) + 1
+        body = (
+            '<html><head><meta name="twitter:data2" content="%.2f out of 5"></head>'
+            '<body class="film" data-tmdb-id="%s">%s</body></html>'
+            % (2 + tmdb_id % 300 / 100, tmdb_id, FILM_PAGE_PADDING)
+        )
+        self.reply(200, body.encode(), "text/html; charset=utf-8")
+
+
+class TMDBHandler(Handler):
+    def do_GET(self):
+        sleep(self.services.latency)
+        path = urlparse(self.path).path
+        if path == "/3/authentication":
+            self.services.count("tmdb_authentication")
+            self.reply_json(200, {"success": True})
+            return
+        self.services.count("tmdb_movie")
+        if self.services.rate_limited(self.services.tmdb_429):
+            self.services.count("tmdb_429")
+            self.reply_json(
+                429, {"status_message": "Rate limited"}, {"Retry-After": "1"}
+            )
+            return
+        tmdb_id = int(path.rstrip("/").split("/")[-1])
+        self.reply_json(
+            200,
+            {
+                "id": tmdb_id,
+                "imdb_id": "tt%07d" % tmdb_id,
+                "release_date": "%s-01-01" % (1950 + tmdb_id % 75),
+                # Every tenth film is a short
+                "runtime": 20 if tmdb_id % 10 == 0 else 80 + tmdb_id % 90,
+            },
+        )
+
+
+class TelegramHandler(Handler):
+    def do_POST(self):
+        sleep(self.services.latency)
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = urlparse(self.path).path.rstrip("/").split("/")[-1]
+        self.services.count("telegram_%s" % method)
+        if self.services.rate_limited(self.services.telegram_429):
+            self.services.count("telegram_429")
+            self.reply_json(
+                429,
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+            )
+            return
+        params = json.loads(data or b"{}")
+        with self.services.lock:
+            self.services.telegram_messages += 1
+            message_id = self.services.telegram_messages
+        self.reply_json(
+            200,
+            {
+                "ok": True,
+                "result": {
+                    "message_id": message_id,
+                    "date": int(datetime.now().timestamp()),
+                    "chat": {"id": int(params.get("chat_id", 0)), "type": "group"},
+                    "text": params.get("text", ""),
+                },
+            },
+        )
+
+
+def serve(handler, services):
+    handler = type(handler.__name__, (handler,), {"services": services})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    handler.base_url = "http://127.0.0.1:%s" % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler.base_url
+
+
+def summarize(data):
+    """
+    Folds a metrics snapshot into per-stage numbers
+    :param data: result of `metrics.snapshot`
+    :return: dict of stage to seconds, runs, http requests and db commits
+    """
+    stages = {}
+
+    def entry(name):
+        return stages.setdefault(
+            name, {"seconds": 0.0, "runs": 0, "requests": 0, "commits": 0}
+        )
+
+    for histogram in data["histograms"]:
+        if histogram["name"] == "moviebob_stage_duration_seconds":
+            stage = entry(histogram["labels"]["stage"])
+            stage["seconds"] += histogram["sum"]
+            stage["runs"] += histogram["count"]
+    for counter in data["counters"]:
+        if counter["name"] == "moviebob_http_requests_total":
+            entry(counter["labels"]["stage"])["requests"] += counter["value"]
+        elif counter["name"] == "moviebob_db_commits_total":
+            entry(counter["labels"]["stage"])["commits"] += counter["value"]
+        elif counter["name"] == "moviebob_telegram_requests_total":
+            entry("dispatch_send")["requests"] += counter["value"]
+    return stages
+
+
+def skip_yearly_recap(path):
+    # Feeds only reach back a few months, a recap of last year would be
+    # empty. The recap queries have their own benchmark.
+    db = helper.DB(path)
+    with db.ops() as c:
+        c.execute(
+            "INSERT INTO yearly(year, notified) VALUES (?, 1)",
+            (datetime.now().year - 1,),
+        )
+    db.close()
+
+
+def run(moviebob, args, scale, directory, urls):
+    users, entries = scale
+    argv = [
+        "-i",
+        str(args.chat_id),
+        "-t",
+        "123456:benchmark",
+        "-T",
+        "benchmark",
+        "--telegram-api-url",
+        urls["telegram"] + "/bot",
+        "-d",
+        os.path.join(directory, "moviebob.db"),
+        "--tmdb-cache-size",
+        "0",
+        "--digest-threshold",
+        str(args.digest_threshold),
+    ]
+    for user in range(users):
+        argv.extend(["-l", "user%04d:User %s" % (user, user)])
+    metrics.reset()
+    started = monotonic()
+    moviebob.main(moviebob.parse_args(argv + args.moviebob_args))
+    return monotonic() - started, summarize(metrics.snapshot())
+
+
+def report(scale, name, seconds, stages, services):
+    print(
+        "\n== %s users x %s entries, %s run: %.2fs wall time"
+        % (scale[0], scale[1], name, seconds)
+    )
+    print("%-34s %8s %10s %9s %8s" % ("stage", "runs", "seconds", "requests", "commits"))
+    for stage, values in sorted(stages.items()):
+        print(
+            "%-34s %8s %10.2f %9s %8s"
+            % (stage, values["runs"], values["seconds"], values["requests"], values["commits"])
+        )
+    print(
+        "service requests: %s"
+        % ", ".join("%s=%s" % item for item in sorted(services.counts.items()))
+    )
+
+
+def main(args):
+    loglevel(level=10 if args.verbose else 30)
+    # Measure the pipeline, not telegram's per-chat limits
+    dispatch.CHAT_RATE = args.telegram_chat_rate
+    dispatch.GROUP_RATE = args.telegram_chat_rate
+    results = []
+    for scale in args.scale:
+        services = Services(
+            scale[0],
+            scale[1],
+            args.films,
+            args.latency / 1000,
+            args.tmdb_429,
+            args.telegram_429,
+            args.seed,
+        )
+        servers = {}
+        urls = {}
+        for name, handler in (
+            ("letterboxd", LetterboxdHandler),
+            ("tmdb", TMDBHandler),
+            ("telegram", TelegramHandler),
+        ):
+            servers[name], urls[name] = serve(handler, services)
+        client.LETTERBOXD_URL = urls["letterboxd"]
+        client.TMDB_URL = urls["tmdb"]
+        moviebob = load_moviebob()
+        if not args.verbose:
+            # main() resets the log level on every run
+            moviebob.loglevel = lambda level: None
+        with tempfile.TemporaryDirectory() as directory:
+            skip_yearly_recap(os.path.join(directory, "moviebob.db"))
+            for name in ("cold", "incremental"):
+                services.counts = {}
+                seconds, stages = run(moviebob, args, scale, directory, urls)
+                report(scale, name, seconds, stages, services)
+                results.append(
+                    {
+                        "users": scale[0],
+                        "entries": scale[1],
+                        "run": name,
+                        "seconds": seconds,
+                        "stages": stages,
+                        "service_requests": dict(services.counts),
+                    }
+                )
+        for server in servers.values():
+            server.shutdown()
+            server.server_close()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Wrote results to '%s'." % args.json)
+
+
+def scale_type(value):
+    users, _, entries = value.partition("x")
+    return int(users), int(entries or 50)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Scales to run
+    parser.add_argument(
+        "--scale",
+        action="append",
+        type=scale_type,
+        help="Users and feed entries per user, e.g. `20x50`. Can be given "
+        "multiple times. Defaults to `5x20`, `20x50` and `50x50`",
+    )
+
+    # Film catalogue
+    parser.add_argument(
+        "--films",
+        action="store",
+        type=int,
+        default=2000,
+        help="Number of distinct films watches are drawn from. Defaults to `2000`",
+    )
+
+    # Service latency
+    parser.add_argument(
+        "--latency",
+        action="store",
+        type=float,
+        default=20,
+        help="Added latency of every fake service response in milliseconds. "
+        "Defaults to `20`",
+    )
+
+    # Rate limit injection
+    parser.add_argument(
+        "--tmdb-429",
+        action="store",
+        type=float,
+        default=0.02,
+        help="Share of TMDB movie requests answered with 429. Defaults to `0.02`",
+    )
+    parser.add_argument(
+        "--telegram-429",
+        action="store",
+        type=float,
+        default=0.02,
+        help="Share of Telegram requests answered with 429. Defaults to `0.02`",
+    )
+
+    # Telegram
+    parser.add_argument(
+        "--chat-id",
+        action="store",
+        default="-100",
+        help="Chat the messages are sent to. Defaults to `-100`",
+    )
+    parser.add_argument(
+        "--telegram-chat-rate",
+        action="store",
+        type=float,
+        default=30,
+        help="Messages per second per chat the dispatcher allows, telegram "
+        "itself allows far less. Defaults to `30`",
+    )
+    parser.add_argument(
+        "--digest-threshold",
+        action="store",
+        type=int,
+        default=0,
+        help="Passed on to moviebob. Defaults to `0`",
+    )
+
+    # Results
+    parser.add_argument(
+        "--json",
+        action="store",
+        help="Write all results to this JSON file",
+    )
+    parser.add_argument(
+        "--seed", action="store", type=int, default=1, help="Defaults to `1`"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Show moviebob's log"
+    )
+    parser.add_argument(
+        "moviebob_args",
+        nargs=argparse.REMAINDER,
+        help="Further moviebob arguments after `--`, e.g. `-- --tmdb-workers 4`",
+    )
+
+    args = parser.parse_args()
+    args.scale = args.scale or [(5, 20), (20, 50), (50, 50)]
+    if args.moviebob_args[:1] == ["--"]:
+        args.moviebob_args = args.moviebob_args[1:]
+    main(args)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Generates a synthetic moviebob database with a realistic watch history, e.g.
+to benchmark the recap queries at sizes no real group reaches yet.
+
+    python scripts/moviebob_generate_history.py history.db --rows 1000000
+
+- users watch at very different paces (log-normal watches per year)
+- films are picked following a zipf curve, a few titles are very popular
+- about 12% of the watches are rewatches of a film the user logged before
+- about 6% of the films are shortfilms, 2% never got a tmdb id
+- the history ends today, so the last month and year are covered
+"""
+
+import os
+import sys
+import random
+import argparse
+from bisect import bisect
+from itertools import accumulate
+from datetime import datetime, timedelta
+from logzero import logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from moviebob import helper
+
+REWATCH_RATIO = 0.12
+SHORTFILM_RATIO = 0.06
+MISSING_TMDB_RATIO = 0.02
+RATED_RATIO = 0.8
+BATCH_SIZE = 50000
+
+
+def generate_films(rng, films):
+    """
+    :return: rows for the tmdb table
+    """
+    rows = []
+    for film in range(1, films + 1):
+        if rng.random() < SHORTFILM_RATIO:
+            runtime = rng.randint(3, 39)
+        else:
+            runtime = max(40, int(rng.gauss(108, 22)))
+        release = datetime(1920, 1, 1) + timedelta(days=rng.randint(0, 105 * 365))
+        rows.append(
+            (
+                film,
+                "tt%07d" % film,
+                release.date().isoformat(),
+                runtime,
+                round(min(4.8, max(0.8, rng.gauss(3.3, 0.5))), 2),
+                datetime.now().isoformat(),
+                "Film %s" % film,
+            )
+        )
+    return rows
+
+
+def generate_watches(rng, users, years, rows, films, tmdb_rows):
+    """
+    Yields movie rows, user by user
+    :return:
+    """
+    # Cumulative zipf weights, sampled with bisect
+    cumulative = list(accumulate(1 / rank for rank in range(1, films + 1)))
+    # Some users log a few films a year, some several hundred
+    paces = [rng.lognormvariate(0, 0.8) for _ in range(users)]
+    scale = rows / sum(paces)
+    end = datetime.now()
+    start = end - timedelta(days=365 * years)
+    span = (end - start).total_seconds()
+    watch = 0
+    for user in range(users):
+        count = int(round(paces[user] * scale)) if user < users - 1 else rows - watch
+        count = max(0, min(count, rows - watch))
+        seen = []
+        dates = sorted(start + timedelta(seconds=rng.random() * span) for _ in range(count))
+        for date in dates:
+            if seen and rng.random() < REWATCH_RATIO:
+                film = rng.choice(seen)
+                rewatch = 1
+            else:
+                film = bisect(cumulative, rng.random() * cumulative[-1]) + 1
+                rewatch = 0
+                seen.append(film)
+            tmdb_id = 0 if rng.random() < MISSING_TMDB_RATIO else film
+            watch += 1
+            yield (
+                "letterboxd-watch-%s" % watch,
+                tmdb_id,
+                "https://letterboxd.com/user%s/film/film-%s/" % (user + 1, film),
+                tmdb_rows[film - 1][6],
+                int(tmdb_rows[film - 1][2][:4]),
+                "%.1f" % (rng.randint(1, 10) / 2) if rng.random() < RATED_RATIO else 0,
+                rewatch,
+                date.replace(microsecond=0).isoformat(),
+                user + 1,
+                1,
+            )
+
+
+def generate(path, rows, users=12, years=5, films=None, seed=1):
+    """
+    Creates a database at `path` holding `rows` watches
+    :param path:
+    :param rows: number of movies rows
+    :param users:
+    :param years: length of the history up to today
+    :param films: size of the film catalogue, defaults to a third of `rows`
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    films = films or max(100, rows // 3)
+    db = helper.DB(path, synchronous="OFF")
+    with db.ops() as c:
+        c.executemany(
+            "INSERT INTO users(user_id, username, nickname, feed_url) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    user,
+                    "user%s" % user,
+                    "User %s" % user,
+                    "https://letterboxd.com/user%s/rss/" % user,
+                )
+                for user in range(1, users + 1)
+            ],
+        )
+        tmdb_rows = generate_films(rng, films)
+        c.executemany(
+            """
+            INSERT INTO tmdb(tmdb_id, imdb_id, release_date, runtime, letterboxd_avg, letterboxd_avg_date, title)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            tmdb_rows,
+        )
+        # The triggers would cost more than the inserts, the migrations
+        # recreate them and rebuild the rollup and schedule once at the end
+        c.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' "
+            "AND (name LIKE 'user_month_stats_%' OR name LIKE 'letterboxd_avg_%')"
+        )
+        for (trigger,) in c.fetchall():
+            c.execute("DROP TRIGGER %s" % trigger)
+
+    batch = []
+    inserted = 0
+    for row in generate_watches(rng, users, years, rows, films, tmdb_rows):
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            inserted += helper.save_movies(db, batch)
+            batch = []
+            logger.info("Inserted %s of %s watches ..." % (inserted, rows))
+    inserted += helper.save_movies(db, batch)
+
+    logger.info("Rebuilding monthly user statistics ...")
+    with db.ops() as c:
+        helper.migrate_v4_user_month_stats(c)
+        helper.migrate_v6_letterboxd_avg_schedule(c)
+        helper.migrate_v7_tmdb_slug(c)
+    db.con.execute("ANALYZE")
+    db.close()
+    logger.info(
+        "Generated %s watches of %s users on %s films at '%s'."
+        % (inserted, users, films, path)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Target database
+    parser.add_argument("database", help="Location of the generated database")
+
+    # History size
+    parser.add_argument(
+        "--rows",
+        action="store",
+        type=int,
+        default=10000,
+        help="Number of watches. Defaults to `10000`",
+    )
+    parser.add_argument(
+        "--users",
+        action="store",
+        type=int,
+        default=12,
+        help="Number of users. Defaults to `12`",
+    )
+    parser.add_argument(
+        "--years",
+        action="store",
+        type=int,
+        default=5,
+        help="Years of history up to today. Defaults to `5`",
+    )
+    parser.add_argument(
+        "--films",
+        action="store",
+        type=int,
+        help="Size of the film catalogue. Defaults to a third of `--rows`",
+    )
+    parser.add_argument(
+        "--seed", action="store", type=int, default=1, help="Defaults to `1`"
+    )
+
+    args = parser.parse_args()
+    if os.path.exists(args.database):
+        logger.error("'%s' exists already. Exiting ..." % args.database)
+        exit(1)
+    generate(args.database, args.rows, args.users, args.years, args.films, args.seed)
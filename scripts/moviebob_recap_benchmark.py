@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Times every recap query and message builder on synthetic histories of
+growing size, see `moviebob_generate_history.py` for the generated data.
+
+    python scripts/moviebob_recap_benchmark.py --rows 10000 --rows 1000000
+
+Databases are kept in `--directory` and reused by later runs with the same
+size and seed, generating 10M rows takes a while.
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+from time import perf_counter
+from datetime import datetime
+from dateutil import relativedelta
+from logzero import logger, loglevel
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from moviebob import helper
+from moviebob import telegram
+from moviebob_generate_history import generate
+
+
+def query(db, sql, params):
+    with db.ops() as c:
+        c.execute(sql, params)
+        return c.fetchall()
+
+
+def explain(db, sql, params):
+    with db.ops() as c:
+        c.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in c.fetchall()]
+
+
+def cases(db):
+    """
+    Everything the recaps run, as (name, callable, sql, params). The sql is
+    only set for single queries and used for `--explain`.
+    :param db:
+    :return:
+    """
+    last_month = datetime.now() + relativedelta.relativedelta(months=-1)
+    month_start = "%d-%02d-01" % (last_month.year, last_month.month)
+    month_end = (
+        datetime(last_month.year, last_month.month, 1)
+        + relativedelta.relativedelta(months=1)
+    ).strftime("%Y-%m-%d")
+    year = datetime.now().year - 1
+    year_start = "%d-01-01" % year
+    year_end = "%d-01-01" % (year + 1)
+    best_movie = query(db, telegram.BEST_MOVIE_QUERY, (year_start, year_end))
+    best_tmdb_id = best_movie[0][0] if best_movie else 0
+    user_ids = [row[0] for row in query(db, "SELECT user_id FROM users", ())]
+    stats = helper.fetch_user_stats(db, year_start, year_end)
+    avg_list = [user for user in stats if user.letterboxd_avg is not None]
+
+    def rebuild():
+        with db.ops() as c:
+            helper.rebuild_user_month_stats(c)
+
+    return [
+        (
+            "fetch_user_stats (month)",
+            lambda: helper.fetch_user_stats(db, month_start, month_end),
+            None,
+            None,
+        ),
+        (
+            "fetch_user_stats (year)",
+            lambda: helper.fetch_user_stats(db, year_start, year_end),
+            None,
+            None,
+        ),
+        (
+            "unique films (year)",
+            lambda: query(db, telegram.UNIQUE_COUNT_QUERY, (year_start, year_end)),
+            telegram.UNIQUE_COUNT_QUERY,
+            (year_start, year_end),
+        ),
+        (
+            "best movie (year)",
+            lambda: query(db, telegram.BEST_MOVIE_QUERY, (year_start, year_end)),
+            telegram.BEST_MOVIE_QUERY,
+            (year_start, year_end),
+        ),
+        (
+            "worst movie (year)",
+            lambda: query(db, telegram.WORST_MOVIE_QUERY, (year_start, year_end)),
+            telegram.WORST_MOVIE_QUERY,
+            (year_start, year_end),
+        ),
+        (
+            "movie users",
+            lambda: query(db, telegram.MOVIE_USERS_QUERY, (best_tmdb_id,)),
+            telegram.MOVIE_USERS_QUERY,
+            (best_tmdb_id,),
+        ),
+        (
+            "fetch_pending_notifications",
+            lambda: helper.fetch_pending_notifications(db, user_ids),
+            None,
+            None,
+        ),
+        ("create_monthly_msg", lambda: telegram.create_monthly_msg(db), None, None),
+        (
+            "create_yearly_letterboxd_avg_msg",
+            lambda: telegram.create_yearly_letterboxd_avg_msg(
+                avg_list, db, year_start, year_end
+            ),
+            None,
+            None,
+        ),
+        ("create_yearly_msg", lambda: telegram.create_yearly_msg(year, db), None, None),
+        ("rebuild_user_month_stats", rebuild, None, None),
+    ]
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        func()
+        timings.append(perf_counter() - started)
+    return timings
+
+
+def database_path(args, rows):
+    return os.path.join(
+        args.directory,
+        "history-%s-%su-%sy-%s.db" % (rows, args.users, args.years, args.seed),
+    )
+
+
+def main(args):
+    os.makedirs(args.directory, exist_ok=True)
+    results = []
+    for rows in args.rows:
+        path = database_path(args, rows)
+        if not os.path.exists(path):
+            logger.info("Generating %s watches at '%s' ..." % (rows, path))
+            started = perf_counter()
+            generate(path, rows, args.users, args.years, args.films, args.seed)
+            logger.info("Generated in %.1f seconds." % (perf_counter() - started))
+        db = helper.DB(path)
+        print("\n%s rows (%s)" % (rows, path))
+        print("%-34s %10s %10s %10s" % ("case", "min ms", "median ms", "max ms"))
+        for name, func, sql, params in cases(db):
+            try:
+                timings = measure(func, args.repeat)
+            except Exception as err:
+                logger.error("Case '%s' failed: %s" % (name, err))
+                results.append({"rows": rows, "case": name, "error": str(err)})
+                continue
+            print(
+                "%-34s %10.2f %10.2f %10.2f"
+                % (
+                    name,
+                    min(timings) * 1000,
+                    statistics.median(timings) * 1000,
+                    max(timings) * 1000,
+                )
+            )
+            result = {"rows": rows, "case": name, "seconds": timings}
+            if args.explain and sql:
+                result["plan"] = explain(db, sql, params)
+                for line in result["plan"]:
+                    print("%34s   %s" % ("", line))
+            results.append(result)
+        db.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # History sizes
+    parser.add_argument(
+        "--rows",
+        action="append",
+        type=int,
+        help="Number of watches, can be repeated. Defaults to `10000`, `1000000` and `10000000`",
+    )
+    parser.add_argument(
+        "--users",
+        action="store",
+        type=int,
+        default=12,
+        help="Number of users. Defaults to `12`",
+    )
+    parser.add_argument(
+        "--years",
+        action="store",
+        type=int,
+        default=5,
+        help="Years of history up to today. Defaults to `5`",
+    )
+    parser.add_argument(
+        "--films",
+        action="store",
+        type=int,
+        help="Size of the film catalogue. Defaults to a third of `--rows`",
+    )
+    parser.add_argument(
+        "--seed", action="store", type=int, default=1, help="Defaults to `1`"
+    )
+
+    # Generated databases
+    parser.add_argument(
+        "--directory",
+        action="store",
+        default="recap-benchmark",
+        help="Directory keeping the generated databases. Defaults to `recap-benchmark`",
+    )
+
+    # Measurement
+    parser.add_argument(
+        "--repeat",
+        action="store",
+        type=int,
+        default=5,
+        help="Runs per case. Defaults to `5`",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Print the query plan of every single query",
+    )
+    parser.add_argument(
+        "--json", action="store", help="Also write all timings to this file"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show moviebob's own logging"
+    )
+
+    args = parser.parse_args()
+    args.rows = args.rows or [10000, 1000000, 10000000]
+    if not args.verbose:
+        loglevel(20)
+    main(args)